@@ -14,7 +14,7 @@ find "pymethlab" -iname "*.py" | sort >> "$LANGDIR/python.sources"
 POTFILE="$LANGDIR/methlab.pot"
 echo "Generating translation template $POTFILE"
 xgettext -o "$POTFILE" -L Glade -f "$LANGDIR/glade.sources"
-xgettext -j -o "$POTFILE" -L Python -f "$LANGDIR/python.sources"
+xgettext -j -kN_ -o "$POTFILE" -L Python -f "$LANGDIR/python.sources"
 
 rm "$LANGDIR/glade.sources" "$LANGDIR/python.sources"
 
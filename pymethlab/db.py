@@ -21,8 +21,9 @@ __all__ = ['DBThread']
 
 import os
 import sys
+import time
+import signal
 import threading
-import Queue
 from gettext import gettext as _
 
 try:
@@ -35,21 +36,249 @@ except ImportError:
     raise
 
 from querytranslator import *
+from searchtranslator import *
 from dbqueries import *
+from dbmigrations import *
+from dbindexes import *
+from dbcache import *
+from dbscheduler import *
+from dbprofiles import *
+from dbmirror import *
+from dbquerylog import *
+from dbmetrics import *
+from dbmaintenance import *
 
+# A token that can be attached to messages to cancel them. A cancelled
+# message that is still queued is dropped, a running one is interrupted.
+# Either way its callback is not called.
+class DBToken:
+  def __init__(self):
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+# The result of a message, for callers that want to wait for it. All futures
+# of a DBThread share one condition, so submitting a query does not cost an
+# Event (and its lock and condition) per call. Done callbacks run on the
+# database thread; hand them over to a main loop with gobject.idle_add.
+# The result of a message cancelled through its token is None, and
+# cancelled() tells it apart from a failed query.
+class DBFuture:
+  def __init__(self, condition):
+    self.condition = condition
+    self.finished = False
+    self.was_cancelled = False
+    self.value = None
+    self.callbacks = []
+
+  def set_result(self, value, cancelled = False):
+    self.condition.acquire()
+    self.value = value
+    self.was_cancelled = cancelled
+    self.finished = True
+    callbacks = self.callbacks
+    self.callbacks = []
+    self.condition.notifyAll()
+    self.condition.release()
+    for callback in callbacks:
+      callback(self)
+
+  def done(self):
+    return self.finished
+
+  def cancelled(self):
+    return self.was_cancelled
+
+  def result(self):
+    self.condition.acquire()
+    while not self.finished:
+      self.condition.wait()
+    self.condition.release()
+    return self.value
+
+  def add_done_callback(self, callback):
+    self.condition.acquire()
+    if not self.finished:
+      self.callbacks.append(callback)
+      self.condition.release()
+      return
+    self.condition.release()
+    callback(self)
+
+# A message with a chunk_size streams its results: the callback is called
+# for every chunk of at most chunk_size rows, with done set on the last
+# one. The callback can return False to stop fetching further chunks.
+#
+# A message with a function is answered by calling it on the worker (to
+# answer it from memory, see DBMirror), its query is only run when the
+# function returns None.
 class DBMessage:
-  def __init__(self, query, args, callback = None, script = False):
+  def __init__(self, query, args, callback = None, script = False, many = False, chunk_size = None, token = None, kind = None, function = None):
     self.query = query
     self.args = args
+    self.function = function
+    self.answered = False
     self.callback = callback
     self.script = script
+    self.many = many
+    self.chunk_size = chunk_size
+    self.token = token
+    self.future = None
     self.result = None
+    self.done = False
+    self.kind = kind
+    self.queued = time.time()
+    self.callback_time = 0.0
+    self.rows = 0
+
+  def is_cancelled(self):
+    return self.token is not None and self.token.cancelled
+
+  def deliver(self, rows):
+    if not self.chunk_size:
+      self.result = rows
+      self.done = True
+      self.callback(self)
+      return
+    for i in range(0, max(len(rows), 1), self.chunk_size):
+      self.result = rows[i:i + self.chunk_size]
+      self.done = i + self.chunk_size >= len(rows)
+      if self.callback(self) == False:
+        break
+    self.done = True
+
+# Groups the writes of a library scan into transactions. Writes are counted
+# and the transaction is only committed at a checkpoint (the end of a
+# directory or a track, as chosen by the scanner) once batch_size rows are
+# pending, instead of paying for one autocommit per statement.
+class DBScanSession:
+  def __init__(self, db, batch_size = 1000):
+    self.db = db
+    self.batch_size = batch_size
+    self.pending = 0
+    self.db.open_session()
+    self.db.begin()
+
+  def written(self, rows = 1):
+    self.pending += rows
+
+  def checkpoint(self):
+    if self.pending >= self.batch_size:
+      self.db.commit()
+      self.db.begin()
+      self.pending = 0
+
+  def close(self):
+    self.db.commit()
+    self.pending = 0
+    self.db.delete_unused_names()
+    self.db.close_session()
+
+  def add_tracks(self, tracks):
+    if tracks:
+      self.db.add_tracks(tracks)
+      self.written(len(tracks))
+
+  def delete_tracks(self, tracks):
+    if tracks:
+      self.db.delete_tracks(tracks)
+      self.written(len(tracks))
+
+  def delete_dir_by_dir_id(self, dir_id):
+    self.db.delete_dir_by_dir_id(dir_id)
+    self.written()
+
+  def update_dir_mtime(self, dir_id, mtime):
+    self.db.update_dir_mtime(dir_id, mtime)
+    self.written()
+
+class DBReaderThread(threading.Thread):
+  def __init__(self, db):
+    threading.Thread.__init__(self)
+    self.db = db
+
+  def run(self):
+    conn = self.db.connect(True)
+    self.db.serve(conn, self.db.read_queue)
+    conn.close()
 
 class DBThread(threading.Thread):
-  def __init__(self, path = None):
+  # Number of SQLite virtual machine instructions between checks whether
+  # a running query has been cancelled.
+  PROGRESS_INTERVAL = 1000
+
+  # A statement that fails because the database is busy or locked is
+  # retried this many times, waiting BUSY_DELAY seconds longer every time.
+  # Scripts and executemany messages are not retried, part of them may
+  # have been done.
+  BUSY_RETRIES = 3
+  BUSY_DELAY = 0.1
+
+  # Seconds to wait for the sort order and search fields to settle before
+  # the index advisor builds indexes for them.
+  INDEX_DELAY = 2.0
+
+  # Seconds between checks whether the database is due for maintenance.
+  MAINTENANCE_INTERVAL = 60.0
+
+  # The results of the last plain-text search are kept (up to this many
+  # rows) to filter in memory when the next search refines it.
+  REFINE_ROWS = 20000
+
+  # queue_size and bulk_queue_size bound the number of queued interactive
+  # and bulk messages, fairness is the number of interactive messages that
+  # are served in a row while bulk messages are waiting (see
+  # DBPriorityQueue).
+  #
+  # profile names one of the SQLite performance profiles in dbprofiles. An
+  # existing database is only rebuilt with the profile's page size when
+  # rebuild is set, as that rewrites the whole file.
+  #
+  # With mirror set, query_tracks and search_tracks are answered from an
+  # in-memory copy of the library (see DBMirror) where possible.
+  #
+  # Messages whose statement took slow_query_threshold seconds or more to
+  # execute and fetch (not counting the time they waited in the queue) are
+  # kept in the slow-query log (see DBQueryLog), and appended to the
+  # slow_query_log file if given.
+  #
+  # Maintenance (see DBMaintenance) runs for at most maintenance_budget
+  # seconds at a time, a budget of None or 0 turns it off.
+  def __init__(self, path = None, readers = 2, cache_entries = 32, cache_rows = 100000, queue_size = 1000, bulk_queue_size = 100, fairness = 4, profile = None, rebuild = False, mirror = False, slow_query_threshold = 0.25, slow_query_log = None, maintenance_budget = 1.0):
     threading.Thread.__init__(self)
-    self.queue = Queue.Queue()
+    if maintenance_budget:
+      self.maintenance = DBMaintenance(maintenance_budget)
+    else:
+      self.maintenance = None
+    self.maintenance_timer = None
+    self.sessions = 0
+    self.stopped = False
+    self.query_log = DBQueryLog(slow_query_threshold, path = slow_query_log)
+    self.metrics = DBMetrics()
+    if mirror:
+      self.mirror = DBMirror()
+    else:
+      self.mirror = None
+    self.profile_name, self.profile = get_profile(profile)
+    self.rebuild = rebuild
+    self.queue = DBPriorityQueue(queue_size, bulk_queue_size, fairness)
+    self.read_queue = DBPriorityQueue(queue_size, bulk_queue_size, fairness)
+    self.num_readers = readers
+    self.readers = []
     self.lock = threading.Lock()
+    self.search_fields = ()
+    self.fts = None
+    self.indexes = {}
+    self.index_lock = threading.Lock()
+    self.index_timer = None
+    self.generation = 0
+    self.cache = DBResultCache(cache_entries, cache_rows)
+    self.tokens = {}
+    self.last_search = None
+    self.condition = threading.Condition()
+    self.names = {}
+    self.names_lock = threading.Lock()
     if path is None:
       path = os.path.expanduser(os.path.join('~', '.methlab', 'methlab.db'))
     dir = os.path.split(path)[0]
@@ -58,60 +287,227 @@ class DBThread(threading.Thread):
     self.path = path
   
   def start(self):
+    self.migrate()
     threading.Thread.start(self)
-    self.execute(CreateRootTableQuery)
-    self.execute(CreateDirTableQuery)
-    self.execute(CreateTrackTableQuery)
-    self.execute(CreateSearchTableQuery)
-    self.migrate_path_to_dir()
-    self.migrate_dir_mtimes()
+    self.report_profile()
+    self.setup_fts()
+    self.load_indexes()
     self.set_sort_order('album', 'track', 'title')
     self.set_search_fields('artist', 'album', 'title')
+    self.start_readers()
+    self.load_mirror()
+    self.schedule_maintenance(self.MAINTENANCE_INTERVAL)
 
-  def run(self):
+  def start_readers(self):
+    # Readers can only run next to the writer when the database is in WAL
+    # mode, otherwise they would block on (and block) the scanner's writes.
+    if self.num_readers <= 0:
+      return
+    result = self.execute(GetPragmaQuery % 'journal_mode')
+    if not result or str(result[0][0]).lower() != 'wal':
+      print >> sys.stderr, _('Note: Database is not in WAL mode, not using reader connections.')
+      return
+    for i in range(self.num_readers):
+      reader = DBReaderThread(self)
+      reader.start()
+      self.readers.append(reader)
+
+  def connect(self, readonly = False):
     conn = sqlite.connect(self.path)
     conn.isolation_level = None
     conn.text_factory = str
     conn.row_factory = sqlite.Row
+    for pragma in CONNECTION_PRAGMAS:
+      conn.execute(SetPragmaQuery % (pragma, self.profile[pragma]))
+    if readonly:
+      conn.execute(QueryOnlyQuery)
+    return conn
+
+  def run(self):
+    conn = self.connect()
+    self.serve(conn, self.queue)
+    conn.close()
+    self.query_log.close()
+
+  # Every message that changes the database (or ends a transaction, which
+  # is when the readers get to see the changes) starts a new library
+  # generation, invalidating the result cache.
+  def serve(self, conn, queue):
+    queue.add_consumer()
     cursor = conn.cursor()
+    changes = conn.total_changes
     while 1:
-      msg = self.queue.get()
+      msg = queue.get()
       if not msg:
-        self.queue.task_done()
+        queue.task_done()
         break
+      if msg.is_cancelled():
+        if msg.future:
+          msg.future.set_result(None, True)
+        queue.task_done()
+        continue
+      if msg.token:
+        conn.set_progress_handler(msg.is_cancelled, self.PROGRESS_INTERVAL)
+      times = { 'queue': time.time() - msg.queued }
+      try:
+        self.execute_message(cursor, msg, times)
+      except Exception, e:
+        msg.result = None
+        # A cancelled query fails with 'interrupted', that is no error.
+        if not msg.is_cancelled():
+          if msg.script:
+            print >> sys.stderr, _('Error while executing query %(query)s') % { 'query': msg.query + ' ' + str(msg.args) }
+          else:
+            print >> sys.stderr, _('Error while executing query %(query)s') % { 'query': msg.query }
+          print >> sys.stderr, e
+      if msg.token:
+        conn.set_progress_handler(None, 0)
+      if conn.total_changes != changes or msg.query in (CommitQuery, RollbackQuery):
+        changes = conn.total_changes
+        self.generation += 1
+      if msg.callback and not msg.done and not msg.is_cancelled():
+        msg.done = True
+        self.run_callback(msg)
+      if msg.future and msg.is_cancelled():
+        msg.future.set_result(None, True)
+      elif msg.future:
+        msg.future.set_result(msg.result)
+      times['callback'] = msg.callback_time
+      self.log_query(cursor, msg, times)
+      if not msg.chunk_size and msg.result:
+        msg.rows = len(msg.result)
+      self.metrics.record(msg.kind, sum(times.values()) - times['queue'], msg.rows, times['queue'])
+      queue.task_done()
+
+  def execute_message(self, cursor, msg, times):
+    start = time.time()
+    if msg.function:
+      rows = msg.function()
+      if rows is not None:
+        msg.answered = True
+        executed = time.time()
+        times['execute'] = executed - start
+        if msg.chunk_size:
+          self.deliver_chunks(rows, msg)
+        else:
+          msg.result = rows
+        times['fetch'] = time.time() - executed - msg.callback_time
+        return
+    retries = 0
+    while 1:
       try:
         if msg.script:
           cursor.executescript(msg.query)
+        elif msg.many:
+          cursor.executemany(msg.query, msg.args)
         else:
           cursor.execute(msg.query, msg.args)
-        msg.result = cursor.fetchall()
+        break
+      except sqlite.OperationalError, e:
+        error = str(e)
+        if msg.script or msg.many or retries >= self.BUSY_RETRIES or not ('locked' in error or 'busy' in error):
+          raise
+        retries += 1
+        self.metrics.retried()
+        time.sleep(self.BUSY_DELAY * retries)
+    executed = time.time()
+    times['execute'] = executed - start
+    if msg.chunk_size:
+      self.fetch_chunks(cursor, msg)
+    else:
+      msg.result = cursor.fetchall()
+    times['fetch'] = time.time() - executed - msg.callback_time
+
+  def run_callback(self, msg):
+    start = time.time()
+    try:
+      return msg.callback(msg)
+    finally:
+      msg.callback_time += time.time() - start
+
+  # Slow statements get their query plan logged along with their times. Of
+  # an executemany only the first row of arguments is kept.
+  def log_query(self, cursor, msg, times):
+    args = msg.args
+    if msg.many:
+      args = (list(args) or [()])[0]
+    plan = None
+    if self.query_log.is_slow(times) and not msg.script and not msg.answered:
+      try:
+        plan = [row[-1] for row in cursor.execute(ExplainQueryPlanQuery + msg.query, args).fetchall()]
       except Exception, e:
-        if msg.script:
-          print >> sys.stderr, _('Error while executing query %(query)s') % { 'query': msg.query + ' ' + str(msg.args) }
-        else:
-          print >> sys.stderr, _('Error while executing query %(query)s') % { 'query': msg.query }
-        print >> sys.stderr, e
-      if msg.callback:
-        msg.callback(msg)
-      self.queue.task_done()
-    conn.close()
+        plan = [str(e)]
+    self.query_log.record(msg.query, args, times, plan)
+
+  def fetch_chunks(self, cursor, msg):
+    rows = cursor.fetchmany(msg.chunk_size)
+    while 1:
+      if rows:
+        next_rows = cursor.fetchmany(msg.chunk_size)
+      else:
+        next_rows = []
+      msg.result = rows
+      msg.rows += len(rows)
+      msg.done = not next_rows
+      if msg.is_cancelled() or self.run_callback(msg) == False or msg.done:
+        break
+      rows = next_rows
+    # Reset the statement so a reader does not hold on to its snapshot
+    # when the consumer stopped early.
+    msg.done = True
+    cursor.execute(NoopQuery)
+
+  # Streams the rows a message's function answered it with, like
+  # fetch_chunks.
+  def deliver_chunks(self, rows, msg):
+    for i in range(0, max(len(rows), 1), msg.chunk_size):
+      msg.result = rows[i:i + msg.chunk_size]
+      msg.rows += len(msg.result)
+      msg.done = i + msg.chunk_size >= len(rows)
+      if msg.is_cancelled() or self.run_callback(msg) == False or msg.done:
+        break
+    msg.done = True
 
   def stop(self):
-    self.queue.put(None)
+    self.lock.acquire()
+    self.stopped = True
+    timers = [timer for timer in (self.index_timer, self.maintenance_timer) if timer]
+    self.index_timer = None
+    self.maintenance_timer = None
+    self.lock.release()
+    # An index or maintenance pass that is already running gets to finish,
+    # the workers are still there to serve what it queues.
+    for timer in timers:
+      timer.cancel()
+      if timer is not threading.currentThread():
+        timer.join()
+    # Queued behind the bulk messages, so pending scanner writes are not lost.
+    for reader in self.readers:
+      self.read_queue.put(None, PRIORITY_BULK)
+    self.queue.put(None, PRIORITY_BULK)
   
-  def execute(self, query, args = []):
-    event = threading.Event()
-    msg = DBMessage(query, args, lambda msg: event.set())
+  # Queue a query for the writer and return a DBFuture for its result.
+  # Submitting several queries before waiting for the first one keeps the
+  # database busy while the caller does other work.
+  def submit(self, query, args = [], script = False, many = False, kind = None):
+    msg = DBMessage(query, args, script = script, many = many, kind = kind)
+    msg.future = DBFuture(self.condition)
     self.queue.put(msg)
-    event.wait()
-    return msg.result
+    return msg.future
+
+  # Wait for all of the given futures, returns their results.
+  def wait_all(self, futures):
+    self.condition.acquire()
+    while [future for future in futures if not future.finished]:
+      self.condition.wait()
+    self.condition.release()
+    return [future.value for future in futures]
+
+  def execute(self, query, args = []):
+    return self.submit(query, args).result()
 
   def executescript(self, query):
-    event = threading.Event()
-    msg = DBMessage(query, None, lambda msg: event.set(), True)
-    self.queue.put(msg)
-    event.wait()
-    return msg.result
+    return self.submit(query, None, script = True).result()
   
   def executeasync(self, query, args = [], callback = None):
     msg = DBMessage(query, args, callback)
@@ -120,27 +516,171 @@ class DBThread(threading.Thread):
   def executescriptasync(self, query, callback = None):
     msg = DBMessage(query, None, callback, True)
     self.queue.put(msg)
+
+  def executemany(self, query, args):
+    return self.submit(query, args, many = True).result()
+
+  def executemanyasync(self, query, args, callback = None):
+    msg = DBMessage(query, args, callback, many = True)
+    self.queue.put(msg)
+
+  def begin(self):
+    self.execute(BeginQuery)
+
+  def commit(self):
+    self.execute(CommitQuery)
+
+  def rollback(self):
+    self.execute(RollbackQuery)
+    # Names added in the transaction are gone again.
+    self.names_lock.acquire()
+    self.names = {}
+    self.names_lock.release()
+    self.load_mirror()
+
+  def scan_session(self, batch_size = 1000):
+    return DBScanSession(self, batch_size)
+
+  # Maintenance waits while a scan session is open, it would end up in the
+  # session's transaction. Closing a session requests maintenance.
+  def open_session(self):
+    self.lock.acquire()
+    self.sessions += 1
+    self.lock.release()
+
+  def close_session(self):
+    self.lock.acquire()
+    self.sessions -= 1
+    self.lock.release()
+    self.request_maintenance()
+
+  def get_read_queue(self):
+    if self.readers:
+      return self.read_queue
+    return self.queue
+
+  def submitread(self, query, args = [], kind = None, function = None, token = None):
+    msg = DBMessage(query, args, kind = kind, function = function, token = token)
+    msg.future = DBFuture(self.condition)
+    self.get_read_queue().put(msg)
+    return msg.future
+
+  def executeread(self, query, args = [], kind = None, function = None):
+    return self.submitread(query, args, kind, function).result()
+
+  def executereadasync(self, query, args = [], callback = None, chunk_size = None, token = None, kind = None, function = None):
+    msg = DBMessage(query, args, callback, chunk_size = chunk_size, token = token, kind = kind, function = function)
+    self.get_read_queue().put(msg)
+
+  # Start a new interactive search: the previous search is cancelled, both
+  # when it is still queued and when it is running. Pass the returned token
+  # to query_tracks or search_tracks.
+  def new_search_token(self):
+    return self.new_token('search')
+
+  # Like new_search_token, for count_tracks and count_search.
+  def new_count_token(self):
+    return self.new_token('count')
+
+  def new_token(self, name):
+    token = DBToken()
+    self.lock.acquire()
+    if name in self.tokens:
+      self.tokens[name].cancel()
+    self.tokens[name] = token
+    self.lock.release()
+    return token
   
-  def migrate_path_to_dir(self):
-    result = self.get_roots()
-    if result is None:
-      print >> sys.stderr, _('Note: Migrating database (rename path to dir in roots and dirs).')
-      self.executescript(PathToDirMigrationScript)
-
-  def migrate_dir_mtimes(self):
-    result = self.execute(CheckDirMtimeMigration)
-    if result is None:
-      print >> sys.stderr, _('Note: Migrating database (adding directory mtime reference).')
-      self.executescript(DirMtimeMigrationScript)
+  # Migrations run on their own connection before any worker is started, so
+  # nothing can see the database in between schema versions. The profile's
+  # page size is set first, a new database is then created with it.
+  def migrate(self):
+    conn = self.connect()
+    try:
+      conn.execute(SetPragmaQuery % ('page_size', self.profile['page_size']))
+      conn.execute(SetPragmaQuery % ('auto_vacuum', AUTO_VACUUM_INCREMENTAL))
+      migrate(conn)
+      self.setup_database(conn)
+    finally:
+      conn.close()
+
+  def setup_database(self, conn):
+    page_size = conn.execute(GetPragmaQuery % 'page_size').fetchone()[0]
+    auto_vacuum = conn.execute(GetPragmaQuery % 'auto_vacuum').fetchone()[0]
+    if self.rebuild and (page_size != self.profile['page_size'] or auto_vacuum != AUTO_VACUUM_INCREMENTAL):
+      print >> sys.stderr, _('Note: Rebuilding database with page size %(size)i.') % { 'size': self.profile['page_size'] }
+      # The page size of a database in WAL mode can not be changed.
+      conn.execute(SetPragmaQuery % ('journal_mode', 'delete'))
+      conn.execute(SetPragmaQuery % ('page_size', self.profile['page_size']))
+      conn.execute(SetPragmaQuery % ('auto_vacuum', AUTO_VACUUM_INCREMENTAL))
+      conn.execute(VacuumQuery)
+    else:
+      if page_size != self.profile['page_size']:
+        print >> sys.stderr, _('Note: Database page size is %(size)i, rebuild it to use the page size of the profile (%(profile_size)i).') % { 'size': page_size, 'profile_size': self.profile['page_size'] }
+      if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+        print >> sys.stderr, _('Note: Database does not use incremental vacuum, rebuild it to let maintenance reclaim free space.')
+    conn.execute(SetPragmaQuery % ('journal_mode', self.profile['journal_mode']))
+
+  # Returns the values of the profile's pragmas as SQLite reports them on
+  # the writer's connection.
+  def get_profile_settings(self):
+    pragmas = list(DATABASE_PRAGMAS + CONNECTION_PRAGMAS)
+    results = self.wait_all([self.submit(GetPragmaQuery % pragma) for pragma in pragmas])
+    settings = {}
+    for pragma, result in zip(pragmas, results):
+      if result:
+        settings[pragma] = result[0][0]
+    return settings
+
+  def report_profile(self):
+    settings = self.get_profile_settings()
+    settings = ', '.join(['%s=%s' % (pragma, settings.get(pragma, '?')) for pragma in DATABASE_PRAGMAS + CONNECTION_PRAGMAS])
+    print >> sys.stderr, _('Note: Using database profile %(name)s (%(settings)s).') % { 'name': self.profile_name, 'settings': settings }
+
+  # The full-text index uses FTS5's trigram tokenizer (SQLite 3.34 and up),
+  # which matches substrings like the LIKE search does. An index built by
+  # an older version of MethLab matches word prefixes instead, it is
+  # dropped and built again.
+  def setup_fts(self):
+    result = self.execute(GetTableSQLQuery, ('tracks_fts', ))
+    if result:
+      if 'trigram' in result[0][0].lower():
+        self.fts = 'fts5'
+        return
+      print >> sys.stderr, _('Note: Dropping word based full-text search index.')
+      self.executescript(DropFTSScript)
+
+    version = tuple([int(part) for part in self.execute(GetSQLiteVersionQuery)[0][0].split('.')[:3]])
+    if version < (3, 34, 0) or not self.execute(CheckFTS5Query)[0][0]:
+      print >> sys.stderr, _('Note: SQLite has no trigram full-text search support, searching will be slow.')
+      return
+
+    print >> sys.stderr, _('Note: Building full-text search index.')
+    script = 'BEGIN;\n%s;\n%s;\n%s\nCOMMIT;\n' % (CreateFTS5TableQuery, PopulateFTSTableQuery, CreateFTSTriggersScript)
+    if self.executescript(script) is not None:
+      self.fts = 'fts5'
+    else:
+      self.rollback()
 
   def purge(self):
     self.execute(PurgeDirsQuery)
     self.execute(PurgeTracksQuery)
+    self.delete_unused_names()
+    if self.mirror:
+      self.mirror.load([], [])
+    self.request_maintenance()
+
+  # The mirror follows the writes as they are made (before they are
+  # committed), it is loaded again after a rollback or a failed write.
+  def load_mirror(self):
+    if self.mirror:
+      dirs, tracks = self.wait_all([self.submit(LoadMirrorDirsQuery), self.submit(LoadMirrorTracksQuery)])
+      self.mirror.load(dirs or [], tracks or [])
   
   def add_root(self, dir):
     dir = os.path.join(os.path.abspath(dir), '')
-    symbols = (len(dir), dir)
-    result = self.execute(GetRootStartsWithQuery, symbols)
+    symbols = get_prefix_range(dir)
+    result = self.execute(GetRootsInRangeQuery, symbols)
     for row in result:
       if row[0] != dir:
         self.delete_root(row[0])
@@ -156,6 +696,8 @@ class DBThread(threading.Thread):
     if row:
       self.delete_dir_by_dir_id(row[0][0])
     self.execute(DeleteRootQuery, symbols)
+    self.delete_unused_names()
+    self.request_maintenance()
 
   def get_dir_id(self, parent, dir):
     symbols = (dir, )
@@ -169,6 +711,8 @@ class DBThread(threading.Thread):
       if not row:
         print >> sys.stderr, _("WARNING: could not insert directory '%(dir)s'") % { 'dir': dir }
         return None
+      if self.mirror:
+        self.mirror.add_dir(row[0][0], dir, parent)
       
     return row[0][0]
 
@@ -184,12 +728,17 @@ class DBThread(threading.Thread):
       if not row:
         print >> sys.stderr, _("WARNING: could not insert directory '%(dir)s'") % { 'dir': dir }
         return None, None
+      if self.mirror:
+        self.mirror.add_dir(row[0][0], dir, parent)
       
     return row[0][0], row[0][1]
 
   def get_subdirs_by_dir_id(self, dir_id):
+    return self.submit_subdirs_by_dir_id(dir_id).result()
+
+  def submit_subdirs_by_dir_id(self, dir_id):
     symbols = (dir_id, )
-    return self.execute(GetSubdirsByDirIdQuery, symbols)
+    return self.submit(GetSubdirsByDirIdQuery, symbols)
   
   def get_dirs_without_parent(self):
     return self.execute(GetDirsWithoutParentQuery)
@@ -201,14 +750,29 @@ class DBThread(threading.Thread):
     symbols = (mtime, dir_id)
     self.execute(UpdateDirMtimeQuery, symbols)
     
+  # Deletes a directory together with its subdirectories and their tracks.
+  # The deletes run in a savepoint, so they are atomic both on their own and
+  # inside a scan session's transaction.
   def delete_dir_by_dir_id(self, dir_id):
     symbols = (dir_id, )
-    result = self.execute(GetSubdirsByDirIdQuery, symbols)
-    for row in result:
-      print >> sys.stderr, _("Purging '%(dir)s' because of recursion...") % { 'dir': row[1] }
-      self.delete_dir_by_dir_id(row[0])
-    self.execute(DeleteTracksByDirIdQuery, symbols)
-    self.execute(DeleteDirQuery, symbols)
+    savepoint = 'delete_subtree'
+    self.execute(SavepointQuery % savepoint)
+    results = self.wait_all([self.submit(DeleteSubtreeTracksQuery, symbols), self.submit(DeleteSubtreeDirsQuery, symbols)])
+    if None in results:
+      self.execute(RollbackToSavepointQuery % savepoint)
+    self.execute(ReleaseSavepointQuery % savepoint)
+    if self.mirror:
+      if None in results:
+        self.load_mirror()
+      else:
+        self.mirror.delete_subtree(dir_id)
+
+  # Returns the number of directories and tracks in the subtree of a
+  # directory, the directory itself included.
+  def count_subtree(self, dir_id):
+    symbols = (dir_id, )
+    row = self.executeread(CountSubtreeQuery, symbols)[0]
+    return row[0], row[1]
 
   def get_track_mtime(self, dir_id, filename):
     symbols = (dir_id, filename)
@@ -218,24 +782,90 @@ class DBThread(threading.Thread):
     else:
       return row[0]
 
+  # Artist, album and genre names are interned: their ids are looked up (and
+  # added when needed) once and then kept in memory. The caller holds
+  # names_lock.
+  def get_name_id(self, key, add_query, get_query, symbols):
+    id = self.names.get(key, None)
+    if id is None:
+      self.execute(add_query, symbols)
+      id = self.execute(get_query, symbols)[0][0]
+      self.names[key] = id
+    return id
+
+  def get_album_id(self, artist, album):
+    artist = artist or ''
+    album = album or ''
+    artist_id = self.get_name_id(('artist', artist), AddArtistQuery, GetArtistIdQuery, (artist, ))
+    return self.get_name_id(('album', artist_id, album), AddAlbumQuery, GetAlbumIdQuery, (artist_id, album))
+
+  def get_genre_id(self, genre):
+    genre = genre or ''
+    return self.get_name_id(('genre', genre), AddGenreQuery, GetGenreIdQuery, (genre, ))
+
   def add_track(self, dir_id, filename, mtime, tag):
-    symbols = (dir_id, filename, mtime, tag.album, tag.artist, tag.comment, tag.genre, tag.title, tag.track, tag.year)
-    self.execute(AddTrackQuery, symbols)
+    self.add_tracks([(dir_id, filename, mtime, tag)])
+
+  def add_tracks(self, tracks):
+    self.names_lock.acquire()
+    try:
+      symbols = [(dir_id, filename, mtime, self.get_album_id(tag.artist, tag.album), tag.comment, self.get_genre_id(tag.genre), tag.title, tag.track, tag.year) for dir_id, filename, mtime, tag in tracks]
+      result = self.submit(AddTrackQuery, symbols, many = True, kind = 'add_track').result()
+    finally:
+      self.names_lock.release()
+    if self.mirror:
+      if result is None:
+        self.load_mirror()
+      else:
+        self.mirror.add_tracks(tracks)
+
+  # Remove the names no track refers to anymore. Called after a scan and
+  # after tracks were removed outside of one.
+  def delete_unused_names(self):
+    self.names_lock.acquire()
+    try:
+      self.execute(DeleteUnusedAlbumsQuery)
+      self.execute(DeleteUnusedArtistsQuery)
+      self.execute(DeleteUnusedGenresQuery)
+      self.names = {}
+    finally:
+      self.names_lock.release()
 
   def get_filenames_by_dir_id(self, dir_id):
+    return self.submit_filenames_by_dir_id(dir_id).result()
+
+  def submit_filenames_by_dir_id(self, dir_id):
+    symbols = (dir_id, )
+    return self.submit(GetFilenamesByDirIdQuery, symbols)
+
+  # Returns a future for the (filename, mtime) rows of all tracks in a
+  # directory.
+  def submit_track_mtimes_by_dir_id(self, dir_id):
     symbols = (dir_id, )
-    return self.execute(GetFilenamesByDirIdQuery, symbols)
+    return self.submit(GetTrackMtimesByDirIdQuery, symbols)
 
   def delete_track(self, dir_id, filename):
-    symbols = (dir_id, filename)
-    self.execute(DeleteTrackQuery, symbols)
+    self.delete_tracks([(dir_id, filename)])
+
+  def delete_tracks(self, tracks):
+    result = self.executemany(DeleteTrackQuery, tracks)
+    if self.mirror:
+      if result is None:
+        self.load_mirror()
+      else:
+        self.mirror.delete_tracks(tracks)
 
   def set_search_fields(self, *fields):
-    self.execute(DropSearchViewQuery)
-    if fields:
-      symbol = ' || " " || '.join(fields)
-      symbol = symbol.replace('path', 'dirs.dir || filename')
-      self.execute(CreateSearchViewQuery % symbol)
+    self.lock.acquire()
+    self.search_fields = fields
+    self.lock.release()
+    self.schedule_update_indexes()
+
+  def get_search_fields(self):
+    self.lock.acquire()
+    result = self.search_fields
+    self.lock.release()
+    return result
 
   def set_sort_order(self, *fields):
     self.lock.acquire()
@@ -243,47 +873,402 @@ class DBThread(threading.Thread):
     for field in fields:
         self.sort_order.append(field)
     self.lock.release()
+    self.schedule_update_indexes()
+
+  def get_sort_fields(self):
+    self.lock.acquire()
+    result = tuple(self.sort_order)
+    self.lock.release()
+    return result
 
   def get_sort_order(self):
+    return self.get_order_by(self.get_sort_fields())
+
+  def get_order_by(self, fields):
+    if fields:
+      return ' ORDER BY ' + ', '.join(fields)
+    return ''
+
+  def load_indexes(self):
+    self.index_lock.acquire()
+    self.indexes = {}
+    for row in self.execute(GetIndexesQuery):
+      if row['name'].startswith(INDEX_PREFIX):
+        self.indexes[row['name']] = None
+    self.index_lock.release()
+
+  # Building an index can take a while on a large library, so the advisor
+  # waits until both the sort order and the search fields have been set
+  # instead of building (and dropping) indexes for every intermediate
+  # configuration.
+  def schedule_update_indexes(self):
     self.lock.acquire()
-    if self.sort_order:
-      result = ' ORDER BY ' + ', '.join(self.sort_order)
-    else:
-      result = ''
+    if self.index_timer:
+      self.index_timer.cancel()
+    if not self.stopped:
+      self.index_timer = threading.Timer(self.INDEX_DELAY, self.update_indexes)
+      self.index_timer.setDaemon(True)
+      self.index_timer.start()
+    self.lock.release()
+
+  def update_indexes(self):
+    set_thread_priority(PRIORITY_BULK)
+    self.lock.acquire()
+    if self.stopped:
+      self.lock.release()
+      return
+    sort_order = self.sort_order[:]
+    search_fields = self.search_fields
     self.lock.release()
+
+    advised = advise_indexes(sort_order, search_fields)
+    self.index_lock.acquire()
+    for name in self.indexes.keys():
+      if not name in advised:
+        print >> sys.stderr, _('Note: Dropping index %(name)s.') % { 'name': name }
+        self.executeasync(DropIndexQuery % name)
+        del self.indexes[name]
+    missing = []
+    for name, (query, reason) in advised.items():
+      if name in self.indexes:
+        self.indexes[name] = reason
+      else:
+        missing.append((name, query, reason))
+    self.index_lock.release()
+
+    # An index is only recorded once it has been built, so one that failed
+    # is not reported and is tried again by the next update. The lock is
+    # not held while building, that can take a while.
+    for name, query, reason in missing:
+      print >> sys.stderr, _('Note: Creating index %(name)s for %(reason)s.') % { 'name': name, 'reason': reason }
+      if self.execute(query) is not None:
+        self.index_lock.acquire()
+        self.indexes[name] = reason
+        self.index_lock.release()
+
+  # Returns a list of (name, table, reason) for every index in the database.
+  # Indexes SQLite creates for a PRIMARY KEY or UNIQUE constraint are
+  # labelled by that constraint. The reason is None for indexes that are
+  # not managed by MethLab.
+  def get_indexes(self):
+    self.index_lock.acquire()
+    indexes = self.indexes.copy()
+    self.index_lock.release()
+    constraints = {}
+    result = []
+    for row in self.execute(GetIndexesQuery):
+      name, table = row['name'], row['tbl_name']
+      if name.startswith('sqlite_autoindex_'):
+        if not table in constraints:
+          constraints[table] = self.get_index_origins(table)
+        if constraints[table].get(name) == 'u':
+          reason = _('unique constraint')
+        else:
+          reason = _('primary key')
+      elif name in SchemaIndexes:
+        reason = _('schema')
+      else:
+        reason = indexes.get(name, None)
+      result.append((name, table, reason))
     return result
 
-  def query_tracks(self, query, callback = None):
-    query, symbols = translate_query(query)
-    query = QueryTracksQuery % query + self.get_sort_order()
+  # Maps the names of the indexes on a table to the origin SQLite reports
+  # for them: 'c' for CREATE INDEX, 'u' for UNIQUE and 'pk' for PRIMARY KEY.
+  def get_index_origins(self, table):
+    origins = {}
+    for row in self.execute(GetIndexListQuery % table) or []:
+      if 'origin' in row.keys():
+        origins[row['name']] = row['origin']
+    return origins
+
+  # Maintenance runs on a timer, like the index advisor. When the database
+  # is not due yet the timer is started again, so it checks every
+  # MAINTENANCE_INTERVAL seconds.
+  def schedule_maintenance(self, delay):
+    if not self.maintenance:
+      return
+    self.lock.acquire()
+    if self.maintenance_timer:
+      self.maintenance_timer.cancel()
+    if not self.stopped:
+      self.maintenance_timer = threading.Timer(delay, self.run_maintenance)
+      self.maintenance_timer.setDaemon(True)
+      self.maintenance_timer.start()
+    self.lock.release()
+
+  # Run maintenance as soon as the database settles, after a scan or after
+  # a lot of tracks were removed.
+  def request_maintenance(self):
+    if self.maintenance:
+      self.maintenance.request()
+      self.schedule_maintenance(self.maintenance.SETTLE_TIME)
+
+  # Seconds since the last message was queued for any of the workers.
+  def get_idle_time(self):
+    return min(self.queue.idle_time(), self.read_queue.idle_time())
+
+  def is_interactive_pending(self):
+    return self.queue.qsize(PRIORITY_INTERACTIVE) or self.read_queue.qsize(PRIORITY_INTERACTIVE)
+
+  def run_maintenance(self):
+    set_thread_priority(PRIORITY_BULK)
+    self.lock.acquire()
+    stopped = self.stopped
+    sessions = self.sessions
+    self.lock.release()
+    if stopped:
+      return
+    delay = self.MAINTENANCE_INTERVAL
+    if not sessions and self.maintenance.is_due(self.generation, self.get_idle_time()):
+      if not self.maintenance.run(self):
+        delay = self.maintenance.SETTLE_TIME
+    elif self.maintenance.requested:
+      delay = self.maintenance.SETTLE_TIME
+    self.schedule_maintenance(delay)
+
+  # Returns the report of the last maintenance run (see
+  # DBMaintenance.get_report), or None.
+  def get_maintenance_report(self):
+    if not self.maintenance:
+      return None
+    return self.maintenance.get_report()
+
+  # Run a read query through the result cache. On a hit the callback is
+  # called right away, from the calling thread. Streamed results are only
+  # cached when the consumer fetched all of them. complete, if given, is
+  # called with the whole result once it is known (and not too large to
+  # cache). function, if given, answers the query on the worker (see
+  # DBMessage).
+  def executecached(self, query, args, callback = None, chunk_size = None, token = None, kind = None, complete = None, function = None):
+    key = (query, tuple(args), self.get_search_fields(), self.get_sort_fields())
+    generation = self.generation
+    result = self.cache.get(key, generation)
+    if result is not None:
+      if complete:
+        complete(result)
+      if callback is None:
+        return result
+      DBMessage(query, args, callback, chunk_size = chunk_size).deliver(result)
+      return
+
     if callback is None:
-      return self.execute(query, symbols)
+      result = self.executeread(query, args, kind, function)
+      if result is not None:
+        self.cache.put(key, generation, result)
+        if complete:
+          complete(result)
+      return result
+
+    # rows is None once the result grew too large to cache.
+    state = { 'rows': [] }
+    def store(msg):
+      rows = state['rows']
+      if msg.result is None or rows is None:
+        return callback(msg)
+      rows.extend(msg.result)
+      if len(rows) > self.cache.max_rows:
+        state['rows'] = None
+      elif msg.done:
+        self.cache.put(key, generation, rows)
+        if complete:
+          complete(rows)
+      return callback(msg)
+    self.executereadasync(query, args, store, chunk_size, token, kind, function)
+
+  def get_cache_stats(self):
+    return self.cache.get_stats()
+
+  # Returns the number of messages served, how many of them were slow and
+  # the total time spent in each phase (see dbquerylog.PHASES).
+  def get_query_stats(self):
+    return self.query_log.get_stats()
+
+  # Returns the slow-query log: dicts with the time, query, args, phase
+  # times and query plan of the slowest recent messages.
+  def get_slow_queries(self):
+    return self.query_log.get_slow_queries()
+
+  # Returns the live metrics of the workers (see DBMetrics.get_metrics).
+  def get_metrics(self):
+    return self.metrics.get_metrics({ 'write': self.queue, 'read': self.read_queue })
+
+  # Print the metrics to stderr when the process gets signal signum. Has to
+  # be called from the main thread. Python only runs the handler when the
+  # main thread runs Python code, a main loop has to be woken up by the
+  # signal for it (see MethLabWindow.watch_signals). Returns whether the
+  # handler was installed.
+  def dump_metrics_on_signal(self, signum = None):
+    if signum is None:
+      signum = getattr(signal, 'SIGUSR1', None)
+      if signum is None:
+        return False
+    def dump(signum, frame):
+      print >> sys.stderr, format_metrics(self.get_metrics())
+    signal.signal(signum, dump)
+    return True
+
+  # Takes the page a LIMIT and OFFSET would select from the rows answered
+  # in memory (None if they could not be).
+  def get_page(self, rows, limit, offset):
+    if rows is None or limit is None:
+      return rows
+    return rows[offset:offset + limit]
+
+  def get_limit(self, symbols, limit, offset):
+    if limit is None:
+      return '', symbols
+    return LimitQuery, tuple(symbols) + (limit, offset)
+
+  # query_tracks and search_tracks return the matching tracks, or pass them
+  # to the callback. With a chunk_size they are streamed to the callback in
+  # chunks (see DBMessage), limit and offset select a page of the results.
+  #
+  # The ORDER BY of a query replaces the sort order, its LIMIT caps the
+  # results the page is taken from.
+  #
+  # With the mirror, the worker answers from it where it can, so a query
+  # is never evaluated on the caller's thread.
+  def query_tracks(self, query, callback = None, chunk_size = None, limit = None, offset = 0, token = None):
+    translator = parse_query(query)
+    sort_fields = translator.order or self.get_sort_fields()
+    if translator.limit is not None:
+      remaining = max(translator.limit - offset, 0)
+      if limit is None or limit > remaining:
+        limit = remaining
+    function = None
+    if self.mirror:
+      function = lambda: self.get_page(self.mirror.query(translator.terms, sort_fields), limit, offset)
+    query, symbols = translator.sql_query, tuple(translator.sql_symbols)
+    limit_query, symbols = self.get_limit(symbols, limit, offset)
+    query = QueryTracksQuery % query + self.get_order_by(sort_fields) + limit_query
+    return self.executecached(query, symbols, callback, chunk_size, token, 'query', function = function)
+
+  # Like query_tracks, for all tracks in the subtree of a directory.
+  def query_tracks_by_dir_id(self, dir_id, callback = None, chunk_size = None, limit = None, offset = 0, token = None):
+    limit_query, symbols = self.get_limit((dir_id, ), limit, offset)
+    query = QuerySubtreeTracksQuery + self.get_sort_order() + limit_query
+    return self.executecached(query, symbols, callback, chunk_size, token, 'query')
+
+  # A search that refines the last one (see is_refinement) with the same
+  # fields, sort order and library is answered by filtering the last
+  # results in memory. Every engine (the mirror, the trigram full-text
+  # index and LIKE) matches terms as substrings, so this gives the same
+  # results whichever answered the last search. Like the mirror, the
+  # filtering happens on the worker.
+  def search_tracks(self, query, callback = None, chunk_size = None, limit = None, offset = 0, token = None):
+    clauses = parse_search(query)
+    fields = self.get_search_fields()
+    state = (fields, self.get_sort_fields(), self.generation)
+    complete = None
+    if limit is None and not offset:
+      complete = lambda rows: self.remember_search(state, clauses, rows)
+
+    def function():
+      result = self.refine_search(state, clauses)
+      if result is None and self.mirror and self.mirror.can_search(fields):
+        result = self.mirror.search(clauses, fields, state[1])
+      return self.get_page(result, limit, offset)
+
+    query, match_query, symbols = self.get_search_queries(clauses)
+    limit_query, symbols = self.get_limit(symbols, limit, offset)
+    query += self.get_order_by(state[1]) + limit_query
+    return self.executecached(query, symbols, callback, chunk_size, token, 'search', complete, function)
+
+  def remember_search(self, state, clauses, rows):
+    self.lock.acquire()
+    if len(rows) <= self.REFINE_ROWS:
+      self.last_search = (state, clauses, list(rows))
     else:
-      self.executeasync(query, symbols, callback)
+      self.last_search = None
+    self.lock.release()
 
-  def search_tracks(self, query, callback = None):
-    # Chop op the query:
-    # a b | c d --> (a AND b) OR (c AND d)
+  def refine_search(self, state, clauses):
+    self.lock.acquire()
+    last_search = self.last_search
+    self.lock.release()
+    if last_search is None:
+      return None
+    last_state, last_clauses, rows = last_search
+    if last_state != state or not is_refinement(last_clauses, clauses):
+      return None
+    for field in state[0]:
+      if not field in SearchRow.columns:
+        return None
+    return filter_search(rows, clauses, state[0])
 
-    clauses = []
-    symbols = []
+  # Returns the query fetching the tracks matching a parsed plain-text
+  # search, the query selecting a 1 for each of them and their symbols.
+  def get_search_queries(self, clauses):
+    fields = self.get_search_fields()
+    if self.fts:
+      sql, symbols = translate_fts_search(clauses, [field for field in fields if field in FTSColumns])
+      if sql is not None:
+        return FTSSearchTracksQuery % sql, MatchFTSSearchTracksQuery % sql, symbols
+    sql, symbols = translate_search(clauses, fields)
+    return SearchTracksQuery % sql, MatchSearchTracksQuery % sql, symbols
 
-    queries = [q.strip() for q in query.split('|') if q.strip()]
-    queries = [[p.strip() for p in q.split() if p.strip()] for q in queries]
-    for query in queries:
-      clauses.append(' AND '.join(['field LIKE ?'] * len(query)))
-      symbols += ['%%%s%%' % part for part in query]
+  # count_tracks and count_search count the tracks query_tracks and
+  # search_tracks would return, without fetching them. With a cap they
+  # stop counting after cap matches, for type-ahead feedback. The result is
+  # a (count, exact) pair, (cap, False) meaning more than cap matches, or
+  # None on an error. It is returned, or passed to the callback.
+  def count_tracks(self, query, callback = None, cap = None, token = None):
+    translator = parse_query(query)
+    count = None
+    if self.mirror:
+      count = lambda: self.mirror.count(translator.terms)
+    return self.execute_count(MatchQueryTracksQuery % translator.sql_query, tuple(translator.sql_symbols), translator.limit, cap, callback, token, count)
 
-    query = SearchTracksQuery % ') OR ('.join(clauses)
-    query += self.get_sort_order()
+  def count_search(self, query, callback = None, cap = None, token = None):
+    clauses = parse_search(query)
+    count = None
+    if self.mirror:
+      fields = self.get_search_fields()
+      count = lambda: self.mirror.count_search(clauses, fields)
+    query, match_query, symbols = self.get_search_queries(clauses)
+    return self.execute_count(match_query, symbols, None, cap, callback, token, count)
+
+  # Counting stops after cap + 1 matches, enough to know there are more
+  # than cap. limit is the LIMIT of the query itself. count, if given,
+  # counts the matches on the worker (returning None if it can not).
+  def execute_count(self, match_query, symbols, limit, cap, callback, token, count = None):
+    if cap is not None and (limit is None or limit > cap + 1):
+      limit = cap + 1
+    limit_query, symbols = self.get_limit(symbols, limit, 0)
+    query = CountTracksQuery % (match_query + limit_query)
+    function = None
+    if count:
+      def function():
+        result = count()
+        if result is None:
+          return None
+        return [(result, )]
     if callback is None:
-      return self.execute(query, symbols)
-    else:
-      self.executeasync(query, symbols, callback)
+      return self.deliver_count(self.executecached(query, symbols, kind = 'count', function = function), limit, cap)
+    self.executecached(query, symbols, lambda msg: self.deliver_count(msg.result, limit, cap, callback), token = token, kind = 'count', function = function)
+
+  def deliver_count(self, rows, limit, cap, callback = None):
+    result = None
+    if rows:
+      count = rows[0][0]
+      if limit is not None:
+        count = min(count, limit)
+      if cap is not None and count > cap:
+        result = cap, False
+      else:
+        result = count, True
+    if callback is None:
+      return result
+    callback(result)
 
   def get_distinct_track_info(self, *fields):
-    symbol = ', '.join(fields)
-    return self.execute(GetDistinctTrackInfoQuery % symbol)
+    return self.submit_distinct_track_info(*fields).result()
+
+  def submit_distinct_track_info(self, *fields):
+    query = DistinctTrackInfoQueries.get(fields, None)
+    if query is None:
+      query = GetDistinctTrackInfoQuery % ', '.join(fields)
+    return self.submitread(query, kind = 'distinct')
 
   def get_artists(self):
     return self.get_distinct_track_info('artist')
@@ -305,10 +1290,17 @@ class DBThread(threading.Thread):
     symbols = (name, )
     self.execute(DeleteSearchQuery, symbols)
 
+  # Returns the (artist, album, genre, year, tracks) rows of album_totals:
+  # the number of tracks of every album per genre and year.
+  def get_album_totals(self):
+    return self.submit_album_totals().result()
+
+  def submit_album_totals(self):
+    return self.submitread(GetAlbumTotalsQuery)
+
   def get_stats(self):
-    dirs = self.execute(GetDirCountQuery)[0][0]
-    tracks = self.execute(GetTrackCountQuery)[0][0]
-    return dirs, tracks
+    totals = dict([(row['name'], row['value']) for row in self.executeread(GetLibraryTotalsQuery)])
+    return totals.get('dirs', 0), totals.get('tracks', 0)
   
 if __name__ == '__main__':
   db = DBThread()
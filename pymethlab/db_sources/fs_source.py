@@ -27,6 +27,7 @@ class FilesystemSource:
   def __init__(self, db, yield_func = None):
     self.db = db
     self.yield_func = yield_func
+    self.session = None
 
   def configure(methlab):
     import gtk
@@ -89,11 +90,16 @@ class FilesystemSource:
 
   def update(self):
     dirs = self.db.get_roots()
-    for dir in dirs:
-      self.update_dir(None, dir[0])
-      if self.yield_func:
-        if not self.yield_func():
-          break
+    self.session = self.db.scan_session()
+    try:
+      for dir in dirs:
+        self.update_dir(None, dir[0])
+        if self.yield_func:
+          if not self.yield_func():
+            break
+    finally:
+      self.session.close()
+      self.session = None
 
   def update_dir(self, parent, dir):
     print _('Updating directory %(dir)s') % { 'dir': dir }
@@ -112,10 +118,17 @@ class FilesystemSource:
         self.update_dir(dir_id, subdir[1])
       return
 
+    # Ask for what the database knows about this directory right away, the
+    # answers arrive while the directory is being read.
+    mtimes_future = self.db.submit_track_mtimes_by_dir_id(dir_id)
+    subdirs_future = self.db.submit_subdirs_by_dir_id(dir_id)
+
     found_subdirs = []
     found_files = []
+    new_tracks = []
 
     files = os.listdir(dir)
+    mtimes = dict([(row[0], row[1]) for row in mtimes_future.result() or []])
     for file in files:
       if file[:1] == '.':
         continue
@@ -138,23 +151,23 @@ class FilesystemSource:
         if not os.access(path, os.R_OK):
           continue
         found_files.append(file)
-        if self.db.get_track_mtime(dir_id, file) != statdata.st_mtime:
+        if mtimes.get(file, 0) != long(statdata.st_mtime):
           try:
             tag = get_tag(path)
           except Exception, e:
             print _('WARNING: %(warning)s') % { 'warning': str(e) }
             tag = None
           if tag:
-            self.db.add_track(dir_id, file, long(statdata.st_mtime), tag)
+            new_tracks.append((dir_id, file, long(statdata.st_mtime), tag))
+    self.session.add_tracks(new_tracks)
 
-    db_subdirs = self.db.get_subdirs_by_dir_id(dir_id)
+    db_subdirs = subdirs_future.result() or []
     for subdir in db_subdirs:
       if not subdir[1] in found_subdirs:
-        self.db.delete_dir_by_dir_id(subdir[0])
+        self.session.delete_dir_by_dir_id(subdir[0])
 
-    db_filenames = self.db.get_filenames_by_dir_id(dir_id)
-    for filename in db_filenames:
-      if not filename[0] in found_files:
-        self.db.delete_track(dir_id, filename[0])
+    deleted_tracks = [(dir_id, filename) for filename in mtimes.keys() if not filename in found_files]
+    self.session.delete_tracks(deleted_tracks)
     
-    self.db.update_dir_mtime(dir_id, dirstatdata.st_mtime)
+    self.session.update_dir_mtime(dir_id, dirstatdata.st_mtime)
+    self.session.checkpoint()
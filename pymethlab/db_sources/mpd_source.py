@@ -43,6 +43,13 @@ class MpdSource:
     mpd = mpdclient3.connect()
     mpd_tracks = mpd.do.listallinfo()
 
+    session = self.db.scan_session()
+    try:
+      self.update_tracks(session, mpd_tracks)
+    finally:
+      session.close()
+
+  def update_tracks(self, session, mpd_tracks):
     found = {}
     for mpd_track in mpd_tracks:
       if not self.yield_func():
@@ -50,23 +57,41 @@ class MpdSource:
       if mpd_track['type'] == 'file':
         dir, filename = os.path.split(mpd_track['file'])
         dir = os.path.join(dir, '')
-        dir_id = self.db.get_dir_id(None, dir)
         if not dir in found:
-          found[dir] = [filename]
-        else:
-          found[dir].append(filename)
-        if self.db.get_track_mtime(dir_id, filename) == 0:
+          found[dir] = {}
+        found[dir][filename] = mpd_track
+
+    # Ask for the known files of all directories before waiting for the
+    # first answer, instead of doing a round trip for every track.
+    dir_ids = {}
+    futures = {}
+    for dir in found.keys():
+      dir_ids[dir] = self.db.get_dir_id(None, dir)
+      futures[dir] = self.db.submit_filenames_by_dir_id(dir_ids[dir])
+
+    new_tracks = []
+    db_filenames = {}
+    for dir, tracks in found.items():
+      dir_id = dir_ids[dir]
+      db_filenames[dir] = [row[0] for row in futures[dir].result() or []]
+      known = dict.fromkeys(db_filenames[dir])
+      for filename, mpd_track in tracks.items():
+        if not filename in known:
           tag = MpdTagAbsorber(mpd_track)
-          self.db.add_track(dir_id, filename, 1, tag)
+          new_tracks.append((dir_id, filename, 1, tag))
+          if len(new_tracks) >= session.batch_size:
+            session.add_tracks(new_tracks)
+            session.checkpoint()
+            new_tracks = []
+    session.add_tracks(new_tracks)
 
     db_subdirs = self.db.get_dirs()
     for subdir in db_subdirs:
       if not subdir[1] in found.keys():
-        self.db.delete_dir_by_dir_id(subdir[0])
+        session.delete_dir_by_dir_id(subdir[0])
     
-    for dir, filenames in found.items():
-      dir_id = self.db.get_dir_id(None, dir)
-      db_filenames = self.db.get_filenames_by_dir_id(dir_id)
-      for filename in db_filenames:
-        if not filename[0] in filenames:
-          self.db.delete_track(dir_id, filename[0])
+    for dir, tracks in found.items():
+      dir_id = dir_ids[dir]
+      deleted_tracks = [(dir_id, filename) for filename in db_filenames[dir] if not filename in tracks]
+      session.delete_tracks(deleted_tracks)
+      session.checkpoint()
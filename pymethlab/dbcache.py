@@ -0,0 +1,91 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['DBResultCache']
+
+import threading
+
+# A least recently used cache of query results. Every result belongs to a
+# library generation; as soon as a result for a newer generation is looked
+# up or stored, everything cached for older generations is thrown away.
+# The cache is bounded both by the number of results and by the total
+# number of rows it holds. Results are kept as tuples and handed out as new
+# lists, so a caller changing its result does not change the cache.
+class DBResultCache:
+  def __init__(self, max_entries = 32, max_rows = 100000):
+    self.max_entries = max_entries
+    self.max_rows = max_rows
+    self.lock = threading.Lock()
+    self.generation = 0
+    self.entries = {}
+    self.order = []
+    self.rows = 0
+    self.hits = 0
+    self.misses = 0
+
+  def check_generation(self, generation):
+    if generation > self.generation:
+      self.entries = {}
+      self.order = []
+      self.rows = 0
+      self.generation = generation
+
+  def get(self, key, generation):
+    self.lock.acquire()
+    self.check_generation(generation)
+    result = self.entries.get(key, None)
+    if result is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self.order.remove(key)
+      self.order.append(key)
+      result = list(result)
+    self.lock.release()
+    return result
+
+  def put(self, key, generation, result):
+    if len(result) > self.max_rows:
+      return
+    self.lock.acquire()
+    self.check_generation(generation)
+    if generation == self.generation and not key in self.entries:
+      self.entries[key] = tuple(result)
+      self.order.append(key)
+      self.rows += len(result)
+      while len(self.order) > self.max_entries or self.rows > self.max_rows:
+        self.rows -= len(self.entries.pop(self.order.pop(0)))
+    self.lock.release()
+
+  def clear(self):
+    self.lock.acquire()
+    self.entries = {}
+    self.order = []
+    self.rows = 0
+    self.lock.release()
+
+  def get_stats(self):
+    self.lock.acquire()
+    result = {
+      'hits': self.hits,
+      'misses': self.misses,
+      'entries': len(self.entries),
+      'rows': self.rows,
+      'generation': self.generation,
+    }
+    self.lock.release()
+    return result
@@ -0,0 +1,84 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['INDEX_PREFIX', 'advise_indexes']
+
+from gettext import gettext as _
+
+from dbqueries import CreateIndexQuery
+
+# Only indexes with this prefix are managed (and dropped) by the advisor.
+INDEX_PREFIX = 'advisor_'
+
+TRACK_TEXT_COLUMNS = ('comment', 'title')
+TRACK_COLUMNS = TRACK_TEXT_COLUMNS + ('track', 'year')
+
+# Work out which indexes are useful for the queries MethLab runs with the
+# given sort order and search fields. Returns a dictionary mapping index
+# names to (CREATE INDEX statement, reason). The columns are part of the
+# name, so an index that no longer matches the configuration gets a
+# different name and the old one is dropped.
+#
+# Text columns are indexed with NOCASE collation, that is what the
+# case-insensitive @field = ... comparisons need to be able to use them.
+def advise_indexes(sort_order, search_fields):
+  indexes = {}
+
+  def add(name, table, columns, reason):
+    name = INDEX_PREFIX + name
+    indexes[name] = (CreateIndexQuery % (name, table, ', '.join(columns)), reason)
+
+  add('dirs_parent_id', 'dirs', ['parent_id'],
+      _('subdirectory lookups by parent directory'))
+  # dir UNDER ... (the directories pane) is served by the primary key.
+  add('dirs_dir_nocase', 'dirs', ['dir COLLATE NOCASE'],
+      _('@dir = ... queries'))
+  add('artists_name_nocase', 'artists', ['name COLLATE NOCASE'],
+      _('@artist = ... AND album = ... queries from the artists / albums pane'))
+  add('albums_name_nocase', 'albums', ['name COLLATE NOCASE'],
+      _('@artist = ... AND album = ... queries from the artists / albums pane'))
+
+  for field in search_fields:
+    # artist and album are covered by the artists / albums pane indexes
+    if field == 'genre':
+      add('genres_name_nocase', 'genres', ['name COLLATE NOCASE'],
+          _('@%(field)s = ... queries on search field %(field)s') % { 'field': field })
+    elif field in TRACK_TEXT_COLUMNS:
+      add('tracks_%s_nocase' % field, 'tracks', ['%s COLLATE NOCASE' % field],
+          _('@%(field)s = ... queries on search field %(field)s') % { 'field': field })
+
+  # Only the leading sort fields that live in the tracks table can be
+  # served from an index, path and the names come from other tables.
+  columns = []
+  for field in sort_order:
+    if not field in TRACK_COLUMNS:
+      break
+    columns.append(field)
+  if columns:
+    add('tracks_sort_' + '_'.join(columns), 'tracks', columns,
+        _('ORDER BY %(fields)s from the sort order') % { 'fields': ', '.join(columns) })
+
+  # Sorting on album starts from the albums table instead: with the names
+  # indexed SQLite reads the albums in order and only sorts the tracks of
+  # each album (a temp B-tree for the right part of the ORDER BY), so the
+  # first rows come without sorting the whole library. Artist and genre
+  # names have their UNIQUE index for this already.
+  if sort_order and sort_order[0] == 'album':
+    add('albums_name', 'albums', ['name'],
+        _('ORDER BY album from the sort order'))
+
+  return indexes
@@ -0,0 +1,143 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['AUTO_VACUUM_INCREMENTAL', 'DBMaintenance']
+
+import sys
+import time
+import threading
+from gettext import gettext as _
+
+from dbqueries import *
+
+# The value PRAGMA auto_vacuum reports for incremental vacuum. Free pages
+# can only be given back to the file system in this mode, it is set when a
+# database is created and when it is rebuilt.
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Keeps the planner statistics up to date, gives free pages back to the
+# file system and checkpoints the WAL. run() does one step at a time, each
+# step a single bulk message, and stops once it used up budget seconds or
+# an interactive message is waiting. It is then run again later, until it
+# gets to finish.
+class DBMaintenance:
+  # Pages given back to the file system per step.
+  VACUUM_PAGES = 256
+  # Rows ANALYZE looks at per index, so it takes about as long on a large
+  # library as on a small one.
+  ANALYSIS_LIMIT = 1000
+  # A requested run (after a scan or a purge) waits until no message was
+  # queued for SETTLE_TIME seconds. Otherwise maintenance runs once the
+  # library changed and the database was idle for IDLE_TIME seconds.
+  SETTLE_TIME = 2.0
+  IDLE_TIME = 30.0
+
+  def __init__(self, budget = 1.0):
+    self.budget = budget
+    self.lock = threading.Lock()
+    self.requested = False
+    self.generation = None
+    self.report = None
+
+  def request(self):
+    self.lock.acquire()
+    self.requested = True
+    self.lock.release()
+
+  def is_due(self, generation, idle):
+    self.lock.acquire()
+    if self.requested:
+      result = idle >= self.SETTLE_TIME
+    else:
+      result = generation != self.generation and idle >= self.IDLE_TIME
+    self.lock.release()
+    return result
+
+  def get_pragma(self, db, pragma):
+    result = db.execute(GetPragmaQuery % pragma)
+    if not result:
+      return None
+    return result[0][0]
+
+  def is_interrupted(self, db, deadline):
+    return time.time() >= deadline or db.is_interactive_pending()
+
+  # Returns True when all the work was done, False when it ran out of time
+  # or gave way to an interactive message.
+  def run(self, db):
+    start = time.time()
+    deadline = start + self.budget
+    page_size = self.get_pragma(db, 'page_size') or 0
+    freelist = before = self.get_pragma(db, 'freelist_count') or 0
+
+    # A database that was never analyzed gets a full ANALYZE, after that
+    # PRAGMA optimize only analyzes the tables that need it.
+    db.execute(SetPragmaQuery % ('analysis_limit', self.ANALYSIS_LIMIT))
+    if db.execute(GetTableSQLQuery, ('sqlite_stat1', )):
+      db.execute(OptimizeQuery)
+    else:
+      db.execute(AnalyzeQuery)
+
+    # Every run takes at least one step, so it gets done even when the
+    # budget is small.
+    complete = True
+    if self.get_pragma(db, 'auto_vacuum') == AUTO_VACUUM_INCREMENTAL:
+      while freelist:
+        db.execute(IncrementalVacuumQuery % self.VACUUM_PAGES)
+        freelist = self.get_pragma(db, 'freelist_count') or 0
+        if freelist and self.is_interrupted(db, deadline):
+          complete = False
+          break
+
+    # A passive checkpoint does not wait for the readers.
+    checkpointed = 0
+    if complete:
+      result = db.execute(CheckpointQuery)
+      if result and result[0][2] > 0:
+        checkpointed = result[0][2]
+
+    report = {
+      'time': start,
+      'duration': time.time() - start,
+      'reclaimed': max(before - freelist, 0) * page_size,
+      'free': freelist * page_size,
+      'checkpointed': checkpointed,
+      'complete': complete,
+    }
+    self.lock.acquire()
+    if self.report and not self.report['complete']:
+      report['reclaimed'] += self.report['reclaimed']
+    self.report = report
+    if complete:
+      self.requested = False
+      self.generation = db.generation
+    self.lock.release()
+    if complete:
+      print >> sys.stderr, _('Note: Database maintenance reclaimed %(reclaimed)i KiB and checkpointed %(frames)i pages.') % { 'reclaimed': report['reclaimed'] / 1024, 'frames': checkpointed }
+    return complete
+
+  # Returns the report of the last run: its start time and duration, the
+  # bytes given back to the file system (over all runs it took to finish),
+  # the bytes still free in the file, the number of WAL pages checkpointed
+  # and whether it finished. None before the first run.
+  def get_report(self):
+    self.lock.acquire()
+    result = self.report
+    if result is not None:
+      result = result.copy()
+    self.lock.release()
+    return result
@@ -0,0 +1,143 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['KINDS', 'PERCENTILES', 'DBMetrics', 'flatten_metrics', 'format_metrics']
+
+import time
+import threading
+from collections import deque
+
+# The kinds of messages latencies are kept for. Messages without a kind
+# are counted as 'other'.
+KINDS = ('search', 'query', 'count', 'add_track', 'distinct', 'other')
+PERCENTILES = (50, 95, 99)
+
+# Upper bounds (in seconds) of the latency histogram buckets. The last
+# bucket holds everything slower.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.count = 0
+    self.total = 0.0
+
+  def add(self, value):
+    for i, bound in enumerate(BUCKETS):
+      if value <= bound:
+        break
+    else:
+      i = len(BUCKETS)
+    self.counts[i] += 1
+    self.count += 1
+    self.total += value
+
+  # The upper bound of the bucket the percentile falls in, so percentiles
+  # are never reported faster than they were.
+  def percentile(self, p):
+    if not self.count:
+      return 0.0
+    needed = self.count * p / 100.0
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if seen >= needed:
+        break
+    if i < len(BUCKETS):
+      return BUCKETS[i]
+    return float('inf')
+
+  def get_summary(self):
+    result = { 'count': self.count, 'total': self.total }
+    for p in PERCENTILES:
+      result['p%i' % p] = self.percentile(p)
+    return result
+
+# Live counters for the database worker: messages served (and how many per
+# second over the last window seconds), rows returned, busy / locked
+# retries, a latency histogram per kind of message and one of the time
+# messages waited in the queue. The latency is the time the worker spent
+# on a message, the queue wait is kept apart so a backed up queue does not
+# make every message look slow.
+class DBMetrics:
+  def __init__(self, window = 10):
+    self.window = window
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.messages = 0
+    self.rows = 0
+    self.retries = 0
+    self.recent = deque()
+    self.histograms = dict([(kind, Histogram()) for kind in KINDS])
+    self.queue_wait = Histogram()
+
+  def record(self, kind, latency, rows, queue_wait = 0.0):
+    now = time.time()
+    self.lock.acquire()
+    self.messages += 1
+    self.rows += rows
+    self.histograms.get(kind, self.histograms['other']).add(latency)
+    self.queue_wait.add(queue_wait)
+    self.recent.append(now)
+    self.expire(now)
+    self.lock.release()
+
+  def retried(self):
+    self.lock.acquire()
+    self.retries += 1
+    self.lock.release()
+
+  def expire(self, now):
+    while self.recent and self.recent[0] < now - self.window:
+      self.recent.popleft()
+
+  # Returns the metrics as a dict. queues maps a queue name to its
+  # DBPriorityQueue, their depth per priority is included.
+  def get_metrics(self, queues = {}):
+    now = time.time()
+    self.lock.acquire()
+    self.expire(now)
+    window = min(self.window, now - self.started) or 1.0
+    result = {
+      'messages': self.messages,
+      'messages_per_second': len(self.recent) / window,
+      'rows': self.rows,
+      'retries': self.retries,
+      'latency': {},
+      'queue_wait': self.queue_wait.get_summary(),
+      'queues': {},
+    }
+    for kind, histogram in self.histograms.items():
+      result['latency'][kind] = histogram.get_summary()
+    self.lock.release()
+    for name, queue in queues.items():
+      result['queues'][name] = { 'interactive': queue.qsize(0), 'bulk': queue.qsize(1) }
+    return result
+
+# Turn the metrics into a flat dict of numbers, for D-Bus.
+def flatten_metrics(metrics):
+  result = {}
+  for key, value in metrics.items():
+    if isinstance(value, dict):
+      for subkey, subvalue in flatten_metrics(value).items():
+        result['%s_%s' % (key, subkey)] = subvalue
+    else:
+      result[key] = float(value)
+  return result
+
+def format_metrics(metrics):
+  return '\n'.join(['%s = %s' % (key, value) for key, value in sorted(flatten_metrics(metrics).items())])
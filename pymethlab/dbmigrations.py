@@ -0,0 +1,98 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['MIGRATIONS', 'SCHEMA_VERSION', 'get_schema_version', 'migrate']
+
+import sys
+from gettext import gettext as _
+
+from dbqueries import *
+
+# Marks a string for translation without translating it yet: the
+# descriptions below are built at import time, before the GUI installs its
+# translation, and are translated when they are printed.
+def N_(message):
+  return message
+
+# The schema version is stored in PRAGMA user_version. Every migration brings
+# the schema from the previous version to its own version, and runs in a
+# single transaction together with the user_version update, so it is run
+# exactly once.
+MIGRATIONS = [
+  (1, N_('rename path to dir in roots and dirs'), PathToDirMigrationScript),
+  (2, N_('adding directory mtime reference'), DirMtimeMigrationScript),
+  (3, N_('moving artist, album and genre names to their own tables'), NormalizeNamesMigrationScript),
+  (4, N_('adding artist / album and library totals'), AlbumTotalsMigrationScript),
+]
+
+# New databases are created with the version 2 schema and then brought up to
+# date by the remaining migrations, so they always end up with the exact same
+# schema as migrated ones.
+BASE_SCHEMA_VERSION = 2
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_column_names(conn, table):
+  return [row[1] for row in conn.execute(GetTableInfoQuery % table).fetchall()]
+
+# Work out the version of a database that predates PRAGMA user_version. This
+# only looks at the schema, never at the rows, and only happens once: the
+# first migration run records the version. Returns None for an empty
+# database.
+#
+# Those versions created any missing table on every start, so the base
+# schema (which only creates tables that do not exist) is run on a legacy
+# database before it is migrated, the migrations need tracks to exist.
+def get_legacy_schema_version(conn):
+  if not conn.execute(GetTableSQLQuery, ('roots', )).fetchall():
+    return None
+  if 'path' in get_column_names(conn, 'roots'):
+    return 0
+  if not 'mtime' in get_column_names(conn, 'dirs'):
+    return 1
+  return 2
+
+def get_schema_version(conn):
+  return conn.execute(GetUserVersionQuery).fetchone()[0]
+
+def run_migration_script(conn, version, script):
+  conn.executescript('BEGIN;\n%s\n%s;\nCOMMIT;\n' % (script, SetUserVersionQuery % version))
+
+# Bring the database on the (plain sqlite) connection conn up to
+# SCHEMA_VERSION. Returns the version the database was at.
+def migrate(conn):
+  version = get_schema_version(conn)
+  old_version = version
+
+  if version == 0:
+    version = get_legacy_schema_version(conn)
+    if version is None:
+      run_migration_script(conn, BASE_SCHEMA_VERSION, CreateBaseSchemaScript)
+      version = BASE_SCHEMA_VERSION
+    else:
+      conn.executescript('BEGIN;\n%sCOMMIT;\n' % CreateBaseSchemaScript)
+
+  if version > SCHEMA_VERSION:
+    print >> sys.stderr, _('WARNING: Database schema version %(version)i is newer than this version of MethLab supports (%(supported)i).') % { 'version': version, 'supported': SCHEMA_VERSION }
+    return old_version
+
+  for migration_version, description, script in MIGRATIONS:
+    if migration_version <= version:
+      continue
+    print >> sys.stderr, _('Note: Migrating database (%(description)s).') % { 'description': _(description) }
+    run_migration_script(conn, migration_version, script)
+
+  return old_version
@@ -0,0 +1,445 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['DBMirror', 'QueryRow', 'SearchRow', 'filter_search']
+
+import re
+import threading
+from array import array
+from itertools import compress, imap
+from gettext import gettext as _
+
+from querytranslator import ascii_lower
+
+# The columns of the rows returned by query_tracks and search_tracks.
+QUERY_COLUMNS = ('path', 'dir', 'album', 'artist', 'comment', 'genre', 'title', 'track', 'year')
+SEARCH_COLUMNS = ('path', 'album', 'artist', 'comment', 'genre', 'title', 'track', 'year')
+
+# Dictionary encoded columns, dir is stored as the dir_id.
+CODED_COLUMNS = ('filename', 'album', 'artist', 'comment', 'genre', 'title', 'track', 'year')
+NUMERIC_COLUMNS = ('track', 'year')
+
+# A result row that, like sqlite.Row, can be indexed by column name.
+class MirrorRow(tuple):
+  columns = ()
+  index = {}
+
+  def __getitem__(self, key):
+    if isinstance(key, str):
+      key = self.index[key]
+    return tuple.__getitem__(self, key)
+
+  def keys(self):
+    return list(self.columns)
+
+class QueryRow(MirrorRow):
+  columns = QUERY_COLUMNS
+  index = dict([(column, i) for i, column in enumerate(QUERY_COLUMNS)])
+
+class SearchRow(MirrorRow):
+  columns = SEARCH_COLUMNS
+  index = dict([(column, i) for i, column in enumerate(SEARCH_COLUMNS)])
+
+# SQLite orders NULL before numbers and numbers before text.
+def sql_key(value):
+  if value is None:
+    return (0, )
+  if isinstance(value, (int, long, float)):
+    return (1, value)
+  return (2, value)
+
+# A literal compared to a column with INTEGER affinity is converted to a
+# number if it looks like one.
+def apply_affinity(value, numeric):
+  if numeric and isinstance(value, str):
+    for convert in (int, float):
+      try:
+        return convert(value)
+      except ValueError:
+        pass
+  return value
+
+def encode(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+# LIKE is case insensitive for ASCII letters only, as is re.I on byte strings.
+def compile_like(pattern):
+  parts = []
+  for c in pattern:
+    if c == '%':
+      parts.append('.*')
+    elif c == '_':
+      parts.append('.')
+    else:
+      parts.append(re.escape(c))
+  return re.compile(''.join(parts) + r'\Z', re.I | re.S)
+
+# Returns a function giving True, False or None (for NULL) for a column value
+# compared with the SQL operator.
+def compile_test(operator, values, numeric):
+  if operator in ('LIKE', 'NOT LIKE'):
+    regex = compile_like(values[0])
+    negate = operator == 'NOT LIKE'
+    def test(value):
+      if value is None:
+        return None
+      return (regex.match(str(value)) is None) == negate
+    return test
+  if operator == 'IN' and not numeric:
+    # IN compares text fields without case, like the NOCASE collation.
+    folded = set([ascii_lower(value) for value in values])
+    def test(value):
+      if value is None:
+        return None
+      return ascii_lower(str(value)) in folded
+    return test
+  keys = [sql_key(apply_affinity(value, numeric)) for value in values]
+  if operator == 'IN':
+    keys = set(keys)
+    compare = keys.__contains__
+  elif operator == 'UNDER' and values[1] is None:
+    low = keys[0]
+    compare = lambda a: low <= a
+  elif operator == 'UNDER':
+    low, high = keys
+    compare = lambda a: low <= a < high
+  elif operator == 'BETWEEN':
+    low, high = keys
+    compare = lambda a: low <= a <= high
+  else:
+    key = keys[0]
+    compare = {
+      '<': lambda a: a < key,
+      '<=': lambda a: a <= key,
+      '>': lambda a: a > key,
+      '>=': lambda a: a >= key,
+    }[operator]
+  def test(value):
+    if value is None:
+      return None
+    return compare(sql_key(value))
+  return test
+
+class MirrorError(Exception):
+  pass
+
+# Returns the rows (of a previous search_tracks) that match a parsed
+# plain-text search on the given fields, in their order. Each term is a
+# substring match on a field, as in translate_search.
+def filter_search(rows, clauses, fields):
+  clauses = [[(field, compile_like('%%%s%%' % text), negate) for field, text, negate in clause] for clause in clauses]
+  result = []
+  for row in rows:
+    for clause in clauses:
+      for field, regex, negate in clause:
+        if field is not None:
+          values = [row[field]]
+        else:
+          values = [row[name] for name in fields]
+        if bool([value for value in values if value is not None and regex.match(str(value))]) == negate:
+          break
+      else:
+        result.append(row)
+        break
+  return result
+
+# An in-memory copy of the tracks (joined with their names and
+# directories) that answers query_tracks and search_tracks without SQLite.
+#
+# Every column is an array of integer codes into a dictionary of its
+# distinct values, so a predicate is evaluated once per distinct value and
+# then applied to the whole column in a single C level pass (compress over
+# the codes). Rows are removed by moving the last row into their place.
+#
+# Results are sets of row numbers. Comparisons with NULL are unknown, as in
+# SQL, so predicates produce a (true, unknown) pair of sets to get NOT
+# right. Plain-text search terms are substring matches on each search
+# field, as in the LIKE search.
+class DBMirror:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    self.dirs = {}
+    self.rows = {}
+    self.dir_ids = array('l')
+    self.codes = {}
+    self.values = {}
+    self.lookup = {}
+    for column in CODED_COLUMNS:
+      self.codes[column] = array('l')
+      self.values[column] = []
+      self.lookup[column] = {}
+
+  # dirs are (dir_id, dir, parent_id) rows, tracks are (dir_id, filename,
+  # album, artist, comment, genre, title, track, year) rows.
+  def load(self, dirs, tracks):
+    self.lock.acquire()
+    try:
+      self.clear()
+      for dir_id, dir, parent_id in dirs:
+        self.dirs[dir_id] = (dir, parent_id)
+      for row in tracks:
+        self.add_row(row[0], tuple(row)[1:])
+    finally:
+      self.lock.release()
+
+  def get_code(self, column, value):
+    lookup = self.lookup[column]
+    code = lookup.get(value, None)
+    if code is None:
+      code = len(self.values[column])
+      self.values[column].append(value)
+      lookup[value] = code
+    return code
+
+  def add_row(self, dir_id, values):
+    key = (dir_id, values[0])
+    row = self.rows.get(key, None)
+    if row is None:
+      self.rows[key] = len(self.dir_ids)
+      self.dir_ids.append(dir_id)
+      for column, value in zip(CODED_COLUMNS, values):
+        self.codes[column].append(self.get_code(column, value))
+    else:
+      for column, value in zip(CODED_COLUMNS, values):
+        self.codes[column][row] = self.get_code(column, value)
+
+  def delete_row(self, key):
+    row = self.rows.pop(key, None)
+    if row is None:
+      return
+    last = len(self.dir_ids) - 1
+    if row != last:
+      self.dir_ids[row] = self.dir_ids[last]
+      for column in CODED_COLUMNS:
+        self.codes[column][row] = self.codes[column][last]
+      moved = (self.dir_ids[row], self.values['filename'][self.codes['filename'][row]])
+      self.rows[moved] = row
+    self.dir_ids.pop()
+    for column in CODED_COLUMNS:
+      self.codes[column].pop()
+
+  def add_dir(self, dir_id, dir, parent_id):
+    self.lock.acquire()
+    self.dirs[dir_id] = (dir, parent_id)
+    self.lock.release()
+
+  # Names are stored the way DBThread.add_tracks stores them.
+  def add_tracks(self, tracks):
+    self.lock.acquire()
+    try:
+      for dir_id, filename, mtime, tag in tracks:
+        values = (filename, tag.album or '', tag.artist or '', tag.comment, tag.genre or '', tag.title, tag.track, tag.year)
+        values = [encode(value) for value in values]
+        for i, column in enumerate(CODED_COLUMNS):
+          values[i] = apply_affinity(values[i], column in NUMERIC_COLUMNS)
+        self.add_row(dir_id, tuple(values))
+    finally:
+      self.lock.release()
+
+  def delete_tracks(self, tracks):
+    self.lock.acquire()
+    try:
+      for dir_id, filename in tracks:
+        self.delete_row((dir_id, encode(filename)))
+    finally:
+      self.lock.release()
+
+  def delete_subtree(self, dir_id):
+    self.lock.acquire()
+    try:
+      subtree = set([dir_id])
+      while 1:
+        children = set([id for id, (dir, parent_id) in self.dirs.items() if parent_id in subtree]) - subtree
+        if not children:
+          break
+        subtree |= children
+      for key in [key for key in self.rows if key[0] in subtree]:
+        self.delete_row(key)
+      for id in subtree:
+        self.dirs.pop(id, None)
+    finally:
+      self.lock.release()
+
+  def get_size(self):
+    self.lock.acquire()
+    result = len(self.dir_ids)
+    self.lock.release()
+    return result
+
+  # The rows of which a column satisfies test, as a (true, unknown) pair.
+  def evaluate(self, column, test):
+    if column == 'path':
+      dirs = self.dirs
+      filenames = self.values['filename']
+      results = [test(dirs[dir_id][0] + filenames[code]) for dir_id, code in zip(self.dir_ids, self.codes['filename'])]
+      return set(compress(xrange(len(results)), results)), set()
+    if column == 'dir':
+      values = [(dir_id, dir) for dir_id, (dir, parent_id) in self.dirs.items()]
+      codes = self.dir_ids
+    elif column in CODED_COLUMNS:
+      values = enumerate(self.values[column])
+      codes = self.codes[column]
+    else:
+      raise MirrorError(column)
+    true = set()
+    unknown = set()
+    for code, value in values:
+      result = test(value)
+      if result:
+        true.add(code)
+      elif result is None:
+        unknown.add(code)
+    rows = xrange(len(codes))
+    if true:
+      true = set(compress(rows, imap(true.__contains__, codes)))
+    if unknown:
+      unknown = set(compress(rows, imap(unknown.__contains__, codes)))
+    return true, unknown
+
+  # Recursive descent over the terms of a parsed query, with the SQL
+  # precedence NOT > AND > OR.
+  def evaluate_or(self, terms, pos):
+    true, unknown, pos = self.evaluate_and(terms, pos)
+    while pos < len(terms) and terms[pos] == 'OR':
+      true2, unknown2, pos = self.evaluate_and(terms, pos + 1)
+      true = true | true2
+      unknown = (unknown | unknown2) - true
+    return true, unknown, pos
+
+  def evaluate_and(self, terms, pos):
+    true, unknown, pos = self.evaluate_not(terms, pos)
+    while pos < len(terms) and terms[pos] == 'AND':
+      true2, unknown2, pos = self.evaluate_not(terms, pos + 1)
+      unknown = (unknown & (true2 | unknown2)) | (unknown2 & true)
+      true = true & true2
+    return true, unknown, pos
+
+  def evaluate_not(self, terms, pos):
+    if pos >= len(terms):
+      raise MirrorError(_('Unexpected end of query'))
+    term = terms[pos]
+    if term == 'NOT':
+      true, unknown, pos = self.evaluate_not(terms, pos + 1)
+      return set(xrange(len(self.dir_ids))) - true - unknown, unknown, pos
+    if term == '(':
+      true, unknown, pos = self.evaluate_or(terms, pos + 1)
+      if pos >= len(terms) or terms[pos] != ')':
+        raise MirrorError(_('Unbalanced parentheses'))
+      return true, unknown, pos + 1
+    if not isinstance(term, tuple):
+      raise MirrorError(term)
+    field, operator, values = term
+    field = field.lower()
+    true, unknown = self.evaluate(field, compile_test(operator, values, field in NUMERIC_COLUMNS))
+    return true, unknown, pos + 1
+
+  def get_value(self, row, column):
+    if column == 'path':
+      return self.dirs[self.dir_ids[row]][0] + self.values['filename'][self.codes['filename'][row]]
+    if column == 'dir':
+      return self.dirs[self.dir_ids[row]][0]
+    return self.values[column][self.codes[column][row]]
+
+  # A sort field can be followed by ASC or DESC, as in an ORDER BY. Sorting
+  # is stable, so sorting on the fields from last to first gives the order
+  # of the ORDER BY.
+  def get_rows(self, rows, row_class, sort_fields):
+    order = []
+    for field in sort_fields:
+      field = field.split()
+      if not field[0] in QUERY_COLUMNS or not field[1:] in ([], ['ASC'], ['DESC']):
+        raise MirrorError(' '.join(field))
+      order.append((field[0], field[1:] == ['DESC']))
+    get_value = self.get_value
+    rows = sorted(rows)
+    if order and not [descending for field, descending in order if descending]:
+      rows.sort(key = lambda row: [sql_key(get_value(row, field)) for field, descending in order])
+    else:
+      for field, descending in reversed(order):
+        rows.sort(key = lambda row: sql_key(get_value(row, field)), reverse = descending)
+    return [row_class([get_value(row, column) for column in row_class.columns]) for row in rows]
+
+  # The row numbers matching the terms of a parsed query.
+  def match(self, terms):
+    if not terms:
+      return xrange(len(self.dir_ids))
+    rows, unknown, pos = self.evaluate_or(terms, 0)
+    if pos != len(terms):
+      raise MirrorError(terms[pos])
+    return rows
+
+  # The row numbers matching a parsed plain-text search on the given fields.
+  def match_search(self, clauses, fields):
+    rows = set()
+    for clause in clauses:
+      clause_rows = None
+      for field, text, negate in clause:
+        test = compile_test('LIKE', ('%%%s%%' % text, ), False)
+        term_rows = set()
+        if field is not None:
+          term_rows = self.evaluate(field, test)[0]
+        else:
+          for name in fields:
+            term_rows |= self.evaluate(name, test)[0]
+        if negate:
+          term_rows = set(xrange(len(self.dir_ids))) - term_rows
+        if clause_rows is None:
+          clause_rows = term_rows
+        else:
+          clause_rows &= term_rows
+      rows |= clause_rows or set()
+    return rows
+
+  def can_search(self, fields):
+    for field in fields:
+      if field != 'path' and field != 'dir' and not field in CODED_COLUMNS:
+        return False
+    return True
+
+  # Calls function with the lock held, returns None if the mirror can not
+  # answer it.
+  def run(self, function):
+    self.lock.acquire()
+    try:
+      try:
+        return function()
+      except MirrorError:
+        return None
+    finally:
+      self.lock.release()
+
+  # Returns the rows query_tracks returns for the terms of a parsed query
+  # (see querytranslator.parse_query), or None if the query uses something
+  # the mirror can not answer.
+  def query(self, terms, sort_fields = ()):
+    return self.run(lambda: self.get_rows(self.match(terms), QueryRow, sort_fields))
+
+  def count(self, terms):
+    return self.run(lambda: len(self.match(terms)))
+
+  # Returns the rows search_tracks returns for a parsed plain-text search
+  # (see searchtranslator.parse_search) on the given fields, or None.
+  def search(self, clauses, fields, sort_fields = ()):
+    return self.run(lambda: self.get_rows(self.match_search(clauses, fields), SearchRow, sort_fields))
+
+  def count_search(self, clauses, fields):
+    return self.run(lambda: len(self.match_search(clauses, fields)))
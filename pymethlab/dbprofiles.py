@@ -0,0 +1,78 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['DEFAULT_PROFILE', 'PROFILES', 'DATABASE_PRAGMAS', 'CONNECTION_PRAGMAS', 'get_profile']
+
+import sys
+from gettext import gettext as _
+
+# journal_mode and page_size are stored in the database file and set once,
+# by the writer. The other pragmas only last as long as a connection and are
+# set on every connection.
+DATABASE_PRAGMAS = ('journal_mode', 'page_size')
+CONNECTION_PRAGMAS = ('synchronous', 'cache_size', 'mmap_size', 'temp_store')
+
+# The reader connections need journal_mode wal, the safe profile gives them
+# up for SQLite's default rollback journal and fully synced commits. A
+# negative cache_size is in KiB, mmap_size is in bytes. A new page_size only
+# takes effect on an existing database when it is rebuilt.
+PROFILES = {
+  'safe': {
+    'journal_mode': 'delete',
+    'synchronous': 'full',
+    'cache_size': -2000,
+    'mmap_size': 0,
+    'temp_store': 'default',
+    'page_size': 4096,
+  },
+  'balanced': {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16000,
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'memory',
+    'page_size': 4096,
+  },
+  'fast': {
+    'journal_mode': 'wal',
+    'synchronous': 'off',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+    'page_size': 8192,
+  },
+  'lowmem': {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -1000,
+    'mmap_size': 0,
+    'temp_store': 'file',
+    'page_size': 4096,
+  },
+}
+
+DEFAULT_PROFILE = 'balanced'
+
+# Returns the name and settings of a profile, falling back to the default
+# profile for unknown names.
+def get_profile(name):
+  if name is None:
+    name = DEFAULT_PROFILE
+  if not name in PROFILES:
+    print >> sys.stderr, _("WARNING: Unknown database profile '%(name)s', using '%(default)s'.") % { 'name': name, 'default': DEFAULT_PROFILE }
+    name = DEFAULT_PROFILE
+  return name, PROFILES[name]
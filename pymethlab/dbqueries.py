@@ -15,13 +15,33 @@
 #  along with this program; if not, write to the Free Software
 #  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+GetPragmaQuery = '''PRAGMA %s'''
+SetPragmaQuery = '''PRAGMA %s = %s'''
+VacuumQuery = '''VACUUM'''
+IncrementalVacuumQuery = '''PRAGMA incremental_vacuum(%i)'''
+AnalyzeQuery = '''ANALYZE'''
+OptimizeQuery = '''PRAGMA optimize'''
+CheckpointQuery = '''PRAGMA wal_checkpoint(PASSIVE)'''
+ExplainQueryPlanQuery = '''EXPLAIN QUERY PLAN '''
+QueryOnlyQuery = '''PRAGMA query_only = 1'''
+BeginQuery = '''BEGIN'''
+CommitQuery = '''COMMIT'''
+RollbackQuery = '''ROLLBACK'''
+NoopQuery = '''SELECT NULL'''
+LimitQuery = ''' LIMIT ? OFFSET ?'''
+
+GetIndexesQuery = '''SELECT name, tbl_name FROM sqlite_master WHERE type = 'index' ORDER BY name'''
+GetIndexListQuery = '''PRAGMA index_list(%s)'''
+CreateIndexQuery = '''CREATE INDEX IF NOT EXISTS %s ON %s (%s)'''
+DropIndexQuery = '''DROP INDEX IF EXISTS %s'''
+
 CreateRootTableQuery = '''
 CREATE TABLE IF NOT EXISTS roots
 (
   dir TEXT NOT NULL PRIMARY KEY
 )'''
 AddRootQuery = '''INSERT OR IGNORE INTO roots VALUES (?)'''
-GetRootStartsWithQuery = '''SELECT dir FROM roots WHERE SUBSTR(dir, 1, ?) = ?'''
+GetRootsInRangeQuery = '''SELECT dir FROM roots WHERE dir >= ? AND dir < ?'''
 GetRootsQuery = '''SELECT dir FROM roots'''
 DeleteRootQuery = '''DELETE FROM roots WHERE dir = ?'''
 
@@ -39,11 +59,20 @@ GetDirIdAndMtimeQuery = '''SELECT OID, mtime FROM dirs WHERE dir = ?'''
 GetSubdirsByDirIdQuery = '''SELECT OID, dir FROM dirs WHERE parent_id = ?'''
 GetDirsWithoutParentQuery = '''SELECT OID, dir FROM dirs WHERE parent_id IS NULL'''
 GetDirsQuery = '''SELECT OID, dir FROM dirs'''
-GetDirCountQuery = '''SELECT COUNT(*) FROM dirs'''
 UpdateDirMtimeQuery = '''UPDATE dirs SET mtime = ? WHERE OID = ?'''
-DeleteDirQuery = '''DELETE FROM dirs WHERE OID = ?'''
 PurgeDirsQuery = '''DELETE FROM dirs'''
 
+# Subtree operations follow parent_id down from a directory in a single
+# statement. MPD directories have no parent, so the paths can not be used
+# for this.
+SubtreeQuery = '''WITH RECURSIVE subtree(id) AS (SELECT ? UNION SELECT dirs.OID FROM dirs INNER JOIN subtree ON dirs.parent_id = subtree.id) '''
+DeleteSubtreeTracksQuery = SubtreeQuery + '''DELETE FROM tracks WHERE dir_id IN subtree'''
+DeleteSubtreeDirsQuery = SubtreeQuery + '''DELETE FROM dirs WHERE OID IN subtree'''
+CountSubtreeQuery = SubtreeQuery + '''SELECT (SELECT COUNT(*) FROM dirs WHERE OID IN subtree), (SELECT COUNT(*) FROM tracks WHERE dir_id IN subtree)'''
+SavepointQuery = '''SAVEPOINT %s'''
+ReleaseSavepointQuery = '''RELEASE %s'''
+RollbackToSavepointQuery = '''ROLLBACK TO %s'''
+
 CreateTrackTableQuery = '''
 CREATE TABLE IF NOT EXISTS tracks
 (
@@ -60,18 +89,172 @@ CREATE TABLE IF NOT EXISTS tracks
   PRIMARY KEY (dir_id, filename)
 )'''
 GetTrackMtimeQuery = '''SELECT mtime FROM tracks WHERE dir_id = ? AND filename = ?'''
-AddTrackQuery = '''INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+AddTrackQuery = '''INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
 GetFilenamesByDirIdQuery = '''SELECT filename FROM tracks WHERE dir_id = ?'''
+GetTrackMtimesByDirIdQuery = '''SELECT filename, mtime FROM tracks WHERE dir_id = ?'''
 DeleteTrackQuery = '''DELETE FROM tracks WHERE dir_id = ? AND filename = ?'''
-DeleteTracksByDirIdQuery = '''DELETE FROM tracks WHERE dir_id = ?'''
-GetDistinctTrackInfoQuery = '''SELECT DISTINCT %s FROM tracks'''
-QueryTracksQuery = '''SELECT dirs.dir || filename AS path, dirs.dir AS dir, album, artist, comment, genre, title, track, year FROM tracks INNER JOIN dirs ON tracks.dir_id == dirs.OID WHERE %s'''
-GetTrackCountQuery = '''SELECT COUNT(*) FROM tracks'''
+GetDistinctTrackInfoQuery = '''SELECT DISTINCT %s FROM track_info'''
+LoadMirrorDirsQuery = '''SELECT OID, dir, parent_id FROM dirs'''
+LoadMirrorTracksQuery = '''SELECT dir_id, filename, album, artist, comment, genre, title, track, year FROM track_info'''
+QueryTracksQuery = '''SELECT path, dir, album, artist, comment, genre, title, track, year FROM track_info WHERE %s'''
+QuerySubtreeTracksQuery = SubtreeQuery + '''SELECT path, dir, album, artist, comment, genre, title, track, year FROM track_info WHERE dir_id IN subtree'''
 PurgeTracksQuery = '''DELETE FROM tracks'''
 
-DropSearchViewQuery = '''DROP VIEW IF EXISTS search'''
-CreateSearchViewQuery = '''CREATE TEMPORARY VIEW search AS SELECT dirs.dir || filename AS path, dirs.dir AS dir, album, artist, comment, genre, title, track, year, %s AS field FROM tracks INNER JOIN dirs ON tracks.dir_id == dirs.OID'''
-SearchTracksQuery = '''SELECT path, album, artist, comment, genre, title, track, year FROM search WHERE (%s)'''
+SearchTracksQuery = '''SELECT path, album, artist, comment, genre, title, track, year FROM track_info WHERE %s'''
+
+# Counting the matches of a query or search: the Match queries select a 1
+# for every matching track (with the same WHERE clause as the queries that
+# fetch them) and are wrapped in CountTracksQuery, with a LIMIT when only
+# an estimate is needed.
+CountTracksQuery = '''SELECT COUNT(*) FROM (%s)'''
+MatchQueryTracksQuery = '''SELECT 1 FROM track_info WHERE %s'''
+MatchSearchTracksQuery = MatchQueryTracksQuery
+
+# Artist, album and genre names are stored once, in their own tables, and
+# tracks refer to their album (which belongs to an artist) and genre. The
+# track_info view puts the names (and the path) back together.
+CreateArtistTableQuery = '''
+CREATE TABLE IF NOT EXISTS artists
+(
+  id INTEGER PRIMARY KEY,
+  name TEXT NOT NULL UNIQUE
+)'''
+CreateAlbumTableQuery = '''
+CREATE TABLE IF NOT EXISTS albums
+(
+  id INTEGER PRIMARY KEY,
+  artist_id INTEGER NOT NULL,
+  name TEXT NOT NULL,
+  UNIQUE (artist_id, name)
+)'''
+CreateGenreTableQuery = '''
+CREATE TABLE IF NOT EXISTS genres
+(
+  id INTEGER PRIMARY KEY,
+  name TEXT NOT NULL UNIQUE
+)'''
+CreateNormalizedTrackTableQuery = '''
+CREATE TABLE IF NOT EXISTS tracks
+(
+  dir_id INTEGER,
+  filename TEXT NOT NULL,
+  mtime INTEGER,
+  album_id INTEGER NOT NULL,
+  comment TEXT,
+  genre_id INTEGER NOT NULL,
+  title TEXT,
+  track INTEGER,
+  year INTEGER,
+  PRIMARY KEY (dir_id, filename)
+)'''
+CreateTrackInfoViewQuery = '''
+CREATE VIEW IF NOT EXISTS track_info AS
+SELECT tracks.OID AS id, dirs.dir || filename AS path, dirs.dir AS dir, dir_id, filename, tracks.mtime AS mtime, albums.name AS album, artists.name AS artist, comment, genres.name AS genre, title, track, year
+FROM tracks
+INNER JOIN dirs ON tracks.dir_id = dirs.OID
+INNER JOIN albums ON tracks.album_id = albums.id
+INNER JOIN artists ON albums.artist_id = artists.id
+INNER JOIN genres ON tracks.genre_id = genres.id'''
+AddArtistQuery = '''INSERT OR IGNORE INTO artists (name) VALUES (?)'''
+GetArtistIdQuery = '''SELECT id FROM artists WHERE name = ?'''
+AddAlbumQuery = '''INSERT OR IGNORE INTO albums (artist_id, name) VALUES (?, ?)'''
+GetAlbumIdQuery = '''SELECT id FROM albums WHERE artist_id = ? AND name = ?'''
+AddGenreQuery = '''INSERT OR IGNORE INTO genres (name) VALUES (?)'''
+GetGenreIdQuery = '''SELECT id FROM genres WHERE name = ?'''
+DeleteUnusedAlbumsQuery = '''DELETE FROM albums WHERE NOT EXISTS (SELECT 1 FROM album_totals WHERE album_id = albums.id)'''
+DeleteUnusedArtistsQuery = '''DELETE FROM artists WHERE NOT EXISTS (SELECT 1 FROM albums WHERE artist_id = artists.id)'''
+DeleteUnusedGenresQuery = '''DELETE FROM genres WHERE NOT EXISTS (SELECT 1 FROM album_totals WHERE genre_id = genres.id)'''
+# The distinct lists the browser needs come straight from the name tables.
+DistinctTrackInfoQueries = {
+  ('artist', ): '''SELECT name AS artist FROM artists''',
+  ('album', ): '''SELECT DISTINCT name AS album FROM albums''',
+  ('genre', ): '''SELECT name AS genre FROM genres''',
+  ('artist', 'album'): '''SELECT artists.name AS artist, albums.name AS album FROM albums INNER JOIN artists ON albums.artist_id = artists.id''',
+}
+
+# album_totals counts the tracks of every album per genre and year (0 when
+# unknown), library_totals holds the library-wide 'dirs' and 'tracks'
+# counters. Both are kept current by triggers, so the browser and the status
+# bar never have to scan the tracks table.
+CreateAlbumTotalsTableQuery = '''
+CREATE TABLE IF NOT EXISTS album_totals
+(
+  album_id INTEGER NOT NULL,
+  genre_id INTEGER NOT NULL,
+  year INTEGER NOT NULL,
+  tracks INTEGER NOT NULL,
+  PRIMARY KEY (album_id, genre_id, year)
+)'''
+CreateLibraryTotalsTableQuery = '''
+CREATE TABLE IF NOT EXISTS library_totals
+(
+  name TEXT NOT NULL PRIMARY KEY,
+  value INTEGER NOT NULL
+)'''
+GetLibraryTotalsQuery = '''SELECT name, value FROM library_totals'''
+GetAlbumTotalsQuery = '''SELECT artists.name AS artist, albums.name AS album, genres.name AS genre, album_totals.year AS year, album_totals.tracks AS tracks FROM album_totals INNER JOIN albums ON album_totals.album_id = albums.id INNER JOIN artists ON albums.artist_id = artists.id INNER JOIN genres ON album_totals.genre_id = genres.id'''
+# Like the full-text index, the totals rely on tracks_replace to see the
+# rows INSERT OR REPLACE removes.
+CreateTotalsTriggersScript = '''
+CREATE TRIGGER IF NOT EXISTS tracks_replace BEFORE INSERT ON tracks BEGIN
+  DELETE FROM tracks WHERE dir_id = new.dir_id AND filename = new.filename;
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_totals_insert AFTER INSERT ON tracks BEGIN
+  INSERT OR IGNORE INTO album_totals VALUES (new.album_id, new.genre_id, IFNULL(new.year, 0), 0);
+  UPDATE album_totals SET tracks = tracks + 1 WHERE album_id = new.album_id AND genre_id = new.genre_id AND year = IFNULL(new.year, 0);
+  UPDATE library_totals SET value = value + 1 WHERE name = 'tracks';
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_totals_delete AFTER DELETE ON tracks BEGIN
+  UPDATE album_totals SET tracks = tracks - 1 WHERE album_id = old.album_id AND genre_id = old.genre_id AND year = IFNULL(old.year, 0);
+  DELETE FROM album_totals WHERE album_id = old.album_id AND genre_id = old.genre_id AND year = IFNULL(old.year, 0) AND tracks <= 0;
+  UPDATE library_totals SET value = value - 1 WHERE name = 'tracks';
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_totals_update AFTER UPDATE OF album_id, genre_id, year ON tracks BEGIN
+  UPDATE album_totals SET tracks = tracks - 1 WHERE album_id = old.album_id AND genre_id = old.genre_id AND year = IFNULL(old.year, 0);
+  DELETE FROM album_totals WHERE album_id = old.album_id AND genre_id = old.genre_id AND year = IFNULL(old.year, 0) AND tracks <= 0;
+  INSERT OR IGNORE INTO album_totals VALUES (new.album_id, new.genre_id, IFNULL(new.year, 0), 0);
+  UPDATE album_totals SET tracks = tracks + 1 WHERE album_id = new.album_id AND genre_id = new.genre_id AND year = IFNULL(new.year, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS dirs_totals_insert AFTER INSERT ON dirs BEGIN
+  UPDATE library_totals SET value = value + 1 WHERE name = 'dirs';
+END;
+CREATE TRIGGER IF NOT EXISTS dirs_totals_delete AFTER DELETE ON dirs BEGIN
+  UPDATE library_totals SET value = value - 1 WHERE name = 'dirs';
+END;
+'''
+
+FTSColumns = ('path', 'album', 'artist', 'comment', 'genre', 'title', 'track', 'year')
+CheckFTS5Query = '''SELECT sqlite_compileoption_used('ENABLE_FTS5')'''
+GetSQLiteVersionQuery = '''SELECT sqlite_version()'''
+GetTableSQLQuery = '''SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?'''
+CreateFTS5TableQuery = '''CREATE VIRTUAL TABLE tracks_fts USING fts5(path, album, artist, comment, genre, title, track, year, tokenize = "trigram")'''
+PopulateFTSTableQuery = '''INSERT INTO tracks_fts (rowid, path, album, artist, comment, genre, title, track, year) SELECT id, path, album, artist, comment, genre, title, track, year FROM track_info'''
+# The BEFORE INSERT trigger turns INSERT OR REPLACE into a real DELETE so
+# the delete triggers fire even when recursive triggers are disabled.
+CreateFTSTriggersScript = '''
+CREATE TRIGGER IF NOT EXISTS tracks_replace BEFORE INSERT ON tracks BEGIN
+  DELETE FROM tracks WHERE dir_id = new.dir_id AND filename = new.filename;
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_fts_insert AFTER INSERT ON tracks BEGIN
+  INSERT INTO tracks_fts (rowid, path, album, artist, comment, genre, title, track, year) SELECT id, path, album, artist, comment, genre, title, track, year FROM track_info WHERE id = new.OID;
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_fts_delete AFTER DELETE ON tracks BEGIN
+  DELETE FROM tracks_fts WHERE rowid = old.OID;
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_fts_update AFTER UPDATE ON tracks BEGIN
+  DELETE FROM tracks_fts WHERE rowid = old.OID;
+  INSERT INTO tracks_fts (rowid, path, album, artist, comment, genre, title, track, year) SELECT id, path, album, artist, comment, genre, title, track, year FROM track_info WHERE id = new.OID;
+END;
+'''
+# tracks_replace stays, the totals triggers rely on it as well.
+DropFTSScript = '''
+DROP TRIGGER IF EXISTS tracks_fts_insert;
+DROP TRIGGER IF EXISTS tracks_fts_delete;
+DROP TRIGGER IF EXISTS tracks_fts_update;
+DROP TABLE IF EXISTS tracks_fts;
+'''
+FTSSearchTracksQuery = '''SELECT path, album, artist, comment, genre, title, track, year FROM track_info WHERE id IN (%s)'''
+MatchFTSSearchTracksQuery = '''SELECT 1 FROM track_info WHERE id IN (%s)'''
 
 CreateSearchTableQuery = '''
 CREATE TABLE IF NOT EXISTS searches
@@ -84,6 +267,13 @@ AddSearchQuery = '''INSERT OR REPLACE INTO searches VALUES (?, ?, ?)'''
 GetSearchesQuery = '''SELECT * FROM searches'''
 DeleteSearchQuery = '''DELETE FROM searches WHERE name = ?'''
 
+GetUserVersionQuery = '''PRAGMA user_version'''
+SetUserVersionQuery = '''PRAGMA user_version = %i'''
+GetTableInfoQuery = '''PRAGMA table_info(%s)'''
+
+# The version 2 schema, see dbmigrations.
+CreateBaseSchemaScript = ';\n'.join([CreateRootTableQuery, CreateDirTableQuery, CreateTrackTableQuery, CreateSearchTableQuery]) + ';\n'
+
 PathToDirMigrationScript = '''
 ALTER TABLE roots RENAME TO roots_old;
 CREATE TABLE roots (dir TEXT NOT NULL PRIMARY KEY);
@@ -95,10 +285,49 @@ INSERT INTO dirs (OID, dir, parent_id) SELECT OID, path, parent_id FROM dirs_old
 DROP TABLE dirs_old;
 '''
 
-CheckDirMtimeMigration = '''SELECT mtime FROM dirs'''
 DirMtimeMigrationScript = '''
 ALTER TABLE dirs RENAME TO dirs_old;
 CREATE TABLE dirs (dir TEXT NOT NULL PRIMARY KEY, mtime INTEGER, parent_id INTEGER);
 INSERT INTO dirs (OID, dir, parent_id) SELECT OID, dir, parent_id FROM dirs_old;
 DROP TABLE dirs_old;
 '''
+
+# The full-text index is rebuilt (by DBThread.setup_fts) from the new
+# tables. Its triggers have to go first, renaming tracks would fail on them.
+NormalizeNamesMigrationScript = '''
+DROP TRIGGER IF EXISTS tracks_replace;
+DROP TRIGGER IF EXISTS tracks_fts_insert;
+DROP TRIGGER IF EXISTS tracks_fts_delete;
+DROP TRIGGER IF EXISTS tracks_fts_update;
+DROP TABLE IF EXISTS tracks_fts;
+%s;
+%s;
+%s;
+INSERT INTO artists (name) SELECT DISTINCT COALESCE(artist, '') FROM tracks;
+INSERT INTO albums (artist_id, name) SELECT DISTINCT artists.id, COALESCE(album, '') FROM tracks INNER JOIN artists ON artists.name = COALESCE(tracks.artist, '');
+INSERT INTO genres (name) SELECT DISTINCT COALESCE(genre, '') FROM tracks;
+ALTER TABLE tracks RENAME TO tracks_old;
+%s;
+INSERT INTO tracks (OID, dir_id, filename, mtime, album_id, comment, genre_id, title, track, year)
+  SELECT tracks_old.OID, dir_id, filename, mtime, albums.id, comment, genres.id, title, track, year FROM tracks_old
+  INNER JOIN artists ON artists.name = COALESCE(tracks_old.artist, '')
+  INNER JOIN albums ON albums.artist_id = artists.id AND albums.name = COALESCE(tracks_old.album, '')
+  INNER JOIN genres ON genres.name = COALESCE(tracks_old.genre, '');
+DROP TABLE tracks_old;
+CREATE INDEX IF NOT EXISTS tracks_album_id ON tracks (album_id);
+CREATE INDEX IF NOT EXISTS tracks_genre_id ON tracks (genre_id);
+%s;
+''' % (CreateArtistTableQuery, CreateAlbumTableQuery, CreateGenreTableQuery, CreateNormalizedTrackTableQuery, CreateTrackInfoViewQuery)
+
+AlbumTotalsMigrationScript = '''
+%s;
+%s;
+CREATE INDEX IF NOT EXISTS album_totals_genre_id ON album_totals (genre_id);
+INSERT INTO album_totals SELECT album_id, genre_id, IFNULL(year, 0), COUNT(*) FROM tracks GROUP BY album_id, genre_id, IFNULL(year, 0);
+INSERT INTO library_totals SELECT 'dirs', COUNT(*) FROM dirs;
+INSERT INTO library_totals SELECT 'tracks', COUNT(*) FROM tracks;
+%s
+''' % (CreateAlbumTotalsTableQuery, CreateLibraryTotalsTableQuery, CreateTotalsTriggersScript)
+
+# The indexes created by the migrations above.
+SchemaIndexes = ('tracks_album_id', 'tracks_genre_id', 'album_totals_genre_id')
@@ -0,0 +1,115 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['PHASES', 'DBQueryLog']
+
+import sys
+import time
+import threading
+from collections import deque
+from gettext import gettext as _
+
+# The time a message spends waiting in the queue, executing its statement
+# (up to the first row), fetching the rows and in its callback.
+PHASES = ('queue', 'execute', 'fetch', 'callback')
+
+# The phases that make a query slow. Waiting in the queue says more about
+# the messages ahead of it, and the callback is the consumer's time.
+QUERY_PHASES = ('execute', 'fetch')
+
+# Keeps the time spent in each phase over all messages, and the last
+# max_entries messages whose query took threshold seconds or more (with
+# their query plans). Slow messages are also appended to the file at
+# path, if given. A threshold of None turns the slow-query log off.
+class DBQueryLog:
+  def __init__(self, threshold = 0.25, max_entries = 100, path = None):
+    self.threshold = threshold
+    self.path = path
+    self.lock = threading.Lock()
+    self.entries = deque([], max_entries)
+    self.count = 0
+    self.slow = 0
+    self.totals = dict.fromkeys(PHASES, 0.0)
+    self.file = None
+
+  def get_duration(self, times):
+    return sum([times.get(phase, 0.0) for phase in QUERY_PHASES])
+
+  def is_slow(self, times):
+    return self.threshold is not None and self.get_duration(times) >= self.threshold
+
+  # Record the phase times of a message. plan is the list of EXPLAIN QUERY
+  # PLAN details for slow messages, or None.
+  def record(self, query, args, times, plan = None):
+    slow = self.is_slow(times)
+    self.lock.acquire()
+    try:
+      self.count += 1
+      for phase in PHASES:
+        self.totals[phase] += times.get(phase, 0.0)
+      if slow:
+        self.slow += 1
+        entry = {
+          'time': time.time(),
+          'query': query,
+          'args': args,
+          'times': times,
+          'plan': plan,
+        }
+        self.entries.append(entry)
+        if self.path:
+          self.write(entry)
+    finally:
+      self.lock.release()
+
+  def write(self, entry):
+    try:
+      if self.file is None:
+        self.file = open(self.path, 'a')
+      times = ' '.join(['%s=%.3f' % (phase, entry['times'].get(phase, 0.0)) for phase in PHASES])
+      print >> self.file, '%s %.3fs (%s): %s %r' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])), self.get_duration(entry['times']), times, entry['query'], entry['args'])
+      for detail in entry['plan'] or []:
+        print >> self.file, '  ' + detail
+      self.file.flush()
+    except IOError, e:
+      print >> sys.stderr, _("WARNING: Could not write to slow-query log '%(path)s', disabling it.") % { 'path': self.path }
+      print >> sys.stderr, e
+      self.path = None
+
+  def get_stats(self):
+    self.lock.acquire()
+    result = {
+      'queries': self.count,
+      'slow': self.slow,
+      'threshold': self.threshold,
+      'totals': self.totals.copy(),
+    }
+    self.lock.release()
+    return result
+
+  def get_slow_queries(self):
+    self.lock.acquire()
+    result = list(self.entries)
+    self.lock.release()
+    return result
+
+  def close(self):
+    self.lock.acquire()
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+    self.lock.release()
@@ -0,0 +1,130 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['PRIORITY_INTERACTIVE', 'PRIORITY_BULK', 'DBPriorityQueue', 'set_thread_priority', 'get_thread_priority']
+
+import time
+import threading
+from collections import deque
+
+# Queries from the GUI and D-Bus are interactive, the scanner's writes and
+# maintenance work are bulk.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+_local = threading.local()
+
+# Messages are queued with the priority of the thread that queues them,
+# unless they are given one explicitly. Threads are interactive by default.
+def set_thread_priority(priority):
+  _local.priority = priority
+
+def get_thread_priority():
+  return getattr(_local, 'priority', PRIORITY_INTERACTIVE)
+
+# A drop-in replacement for Queue.Queue with a queue per priority class.
+# Interactive messages are served first, but after fairness interactive
+# messages in a row one waiting bulk message is served, so a scan keeps
+# making progress while the GUI is busy. A fairness of 0 gives interactive
+# messages strict priority.
+#
+# Both queues are bounded: producers block in put() while their queue is
+# full. The threads that consume the queue never block there, so a callback
+# running on one of them can not deadlock it.
+class DBPriorityQueue:
+  def __init__(self, maxsize = 0, bulk_maxsize = 0, fairness = 4):
+    self.maxsizes = (maxsize, bulk_maxsize)
+    self.fairness = fairness
+    self.queues = (deque(), deque())
+    self.served = 0
+    self.consumers = set()
+    self.mutex = threading.Lock()
+    self.not_empty = threading.Condition(self.mutex)
+    self.not_full = threading.Condition(self.mutex)
+    self.all_tasks_done = threading.Condition(self.mutex)
+    self.unfinished_tasks = 0
+    self.last_put = 0.0
+
+  def add_consumer(self):
+    self.mutex.acquire()
+    self.consumers.add(threading.currentThread())
+    self.mutex.release()
+
+  def put(self, item, priority = None):
+    if priority is None:
+      priority = get_thread_priority()
+    queue = self.queues[priority]
+    maxsize = self.maxsizes[priority]
+    self.mutex.acquire()
+    try:
+      if maxsize > 0 and not threading.currentThread() in self.consumers:
+        while len(queue) >= maxsize:
+          self.not_full.wait()
+      queue.append(item)
+      self.unfinished_tasks += 1
+      self.last_put = time.time()
+      self.not_empty.notify()
+    finally:
+      self.mutex.release()
+
+  def get(self):
+    self.mutex.acquire()
+    try:
+      interactive, bulk = self.queues
+      while not interactive and not bulk:
+        self.not_empty.wait()
+      if bulk and (not interactive or (self.fairness and self.served >= self.fairness)):
+        self.served = 0
+        item = bulk.popleft()
+      else:
+        if bulk:
+          self.served += 1
+        item = interactive.popleft()
+      # Producers of both classes wait on the same condition.
+      self.not_full.notifyAll()
+      return item
+    finally:
+      self.mutex.release()
+
+  def task_done(self):
+    self.mutex.acquire()
+    self.unfinished_tasks -= 1
+    if not self.unfinished_tasks:
+      self.all_tasks_done.notifyAll()
+    self.mutex.release()
+
+  def join(self):
+    self.mutex.acquire()
+    while self.unfinished_tasks:
+      self.all_tasks_done.wait()
+    self.mutex.release()
+
+  def qsize(self, priority = None):
+    self.mutex.acquire()
+    if priority is None:
+      size = len(self.queues[0]) + len(self.queues[1])
+    else:
+      size = len(self.queues[priority])
+    self.mutex.release()
+    return size
+
+  # Seconds since the last message was queued.
+  def idle_time(self):
+    self.mutex.acquire()
+    idle = time.time() - self.last_put
+    self.mutex.release()
+    return idle
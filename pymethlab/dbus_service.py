@@ -17,6 +17,8 @@
 
 import dbus.service
 
+from pymethlab.dbmetrics import flatten_metrics
+
 class MethLabApplicationDBusProxy(dbus.service.Object):
   def __init__(self, bus, quit_function):
     self.quit_function = quit_function
@@ -47,9 +49,22 @@ class MethLabMainWindowDBusProxy(dbus.service.Object):
   def toggle(self):
     self.window.toggle_window()
 
+class MethLabDatabaseDBusProxy(dbus.service.Object):
+  def __init__(self, bus, db):
+    self.db = db
+    dbus.service.Object.__init__(self, bus, '/org/thegraveyard/MethLab/Database')
+
+  # The metrics of DBThread.get_metrics, flattened to names like
+  # latency_search_p95 or queues_read_interactive.
+  @dbus.service.method('org.thegraveyard.MethLab.Database',
+                       in_signature='', out_signature='a{sd}')
+  def get_metrics(self):
+    return flatten_metrics(self.db.get_metrics())
+
 class MethLabDBusService:
   def __init__(self, quit_function, window):
     session_bus = dbus.SessionBus()
     self.name = dbus.service.BusName('org.thegraveyard.MethLab', bus = session_bus)
     self.app_proxy = MethLabApplicationDBusProxy(session_bus, quit_function)
     self.main_window_proxy = MethLabMainWindowDBusProxy(session_bus, window)
+    self.database_proxy = MethLabDatabaseDBusProxy(session_bus, window.db)
@@ -21,6 +21,7 @@ LICENSE = '''
 import os
 import urllib # For pathname2url
 import sys
+import signal
 from ConfigParser import ConfigParser
 from gettext import gettext as _
 
@@ -32,6 +33,7 @@ import pango
 
 # MethLab imports
 from pymethlab.db import DBThread
+from pymethlab.dbprofiles import DEFAULT_PROFILE
 from pymethlab.querytranslator import QueryTranslatorException
 from pymethlab.drivers import DRIVERS, DummyDriver
 from pymethlab.db_sources import DB_SOURCES, FilesystemSource
@@ -61,6 +63,12 @@ class MethLabWindow:
   DEFAULT_SEARCH_ON_ARTIST_AND_ALBUM = True
   DEFAULT_SEARCH_FIELDS = 'artist album title'
   DEFAULT_SORT_ORDER = 'album track title path artist year genre comment'
+  DEFAULT_DB_PROFILE = DEFAULT_PROFILE
+  DEFAULT_DB_REBUILD = False
+  DEFAULT_DB_MIRROR = False
+  DEFAULT_SLOW_QUERY_THRESHOLD = 0.25
+  DEFAULT_SLOW_QUERY_LOG = ''
+  DEFAULT_DB_MAINTENANCE_BUDGET = 1.0
   # User interface options
   DEFAULT_COLUMN_ORDER = 'path artist album track title year genre comment'
   DEFAULT_VISIBLE_COLUMNS = 'artist album track title'
@@ -72,6 +80,11 @@ class MethLabWindow:
   DEFAULT_DOUBLE_CLICK_ACTION = 'play'
   DEFAULT_GEOMETRY = (640, 380, None, None)
 
+  # Number of search results added to the results view at a time
+  SEARCH_CHUNK_SIZE = 500
+  # While typing only the matches are counted, up to this number
+  COUNT_CAP = 10000
+
   DEFAULT_CONFIG = {
     'options': {
       'db_source': DEFAULT_DB_SOURCE,
@@ -81,6 +94,12 @@ class MethLabWindow:
       'search_on_artist_and_album': `DEFAULT_SEARCH_ON_ARTIST_AND_ALBUM`,
       'search_fields': DEFAULT_SEARCH_FIELDS,
       'sort_order': DEFAULT_SORT_ORDER,
+      'db_profile': DEFAULT_DB_PROFILE,
+      'db_rebuild': `DEFAULT_DB_REBUILD`,
+      'db_mirror': `DEFAULT_DB_MIRROR`,
+      'slow_query_threshold': `DEFAULT_SLOW_QUERY_THRESHOLD`,
+      'slow_query_log': DEFAULT_SLOW_QUERY_LOG,
+      'db_maintenance_budget': `DEFAULT_DB_MAINTENANCE_BUDGET`,
     },
     'interface': {
       'column_order': DEFAULT_COLUMN_ORDER,
@@ -138,9 +157,22 @@ class MethLabWindow:
       self.set_config('options', 'db_source', 'fs')
       need_purge = True
 
-    # Create our database back-end
-    self.db = DBThread()
+    # Create our database back-end. Rebuilding the database is a one-shot
+    # request from the config file.
+    db_rebuild = self.config.getboolean('options', 'db_rebuild')
+    slow_query_log = self.config.get('options', 'slow_query_log')
+    if slow_query_log:
+      slow_query_log = os.path.expanduser(slow_query_log)
+    else:
+      slow_query_log = None
+    self.db = DBThread(profile = self.config.get('options', 'db_profile'), rebuild = db_rebuild, mirror = self.config.getboolean('options', 'db_mirror'), slow_query_threshold = self.config.getfloat('options', 'slow_query_threshold'), slow_query_log = slow_query_log, maintenance_budget = self.config.getfloat('options', 'db_maintenance_budget'))
     self.db.start()
+    # The signal handler only runs when gtk.main() returns to Python. The
+    # signal writes a byte to a pipe the main loop watches, which does.
+    if self.db.dump_metrics_on_signal():
+      self.watch_signals()
+    if db_rebuild:
+      self.set_config('options', 'db_rebuild', False)
     
     # Create our scanner helper
     self.scanner = UpdateHelper(self.db, db_source_class)
@@ -148,6 +180,11 @@ class MethLabWindow:
     # If this value is not 0, searches will not occur
     self.inhibit_search = 1
 
+    # The model the results of the current search go to
+    self.results_model = None
+    # The status bar message with the number of matches while typing
+    self.count_message_id = None
+
     # Some timeout tags we may wish to cancel
     self.search_timeout_tag = None
     self.flash_timeout_tag = None
@@ -782,7 +819,10 @@ class MethLabWindow:
       self.tvArtistsAlbums.expand_all()
 
   def update_artists_albums_model(self):
-    artists = [row['artist'] for row in self.db.get_artists()]
+    # Both lookups run while the artists are merged into the model.
+    artists_future = self.db.submit_distinct_track_info('artist')
+    artists_albums_future = self.db.submit_distinct_track_info('artist', 'album')
+    artists = [row['artist'] for row in artists_future.result()]
     for artist in artists:
       if not self.artist_iters.has_key(artist.lower()):
         iter = self.artists_albums_model.append(None)
@@ -797,7 +837,7 @@ class MethLabWindow:
           if artist_ == artist:
             del self.album_iters[(artist_, album_)]
 
-    artists_albums = [(row['artist'], row['album']) for row in self.db.get_artists_albums()]
+    artists_albums = [(row['artist'], row['album']) for row in artists_albums_future.result()]
     for artist, album in artists_albums:
       key = (artist.lower(), album.lower())
       if not self.album_iters.has_key(key):
@@ -834,8 +874,9 @@ class MethLabWindow:
   def update_directories_model(self):
     directories = []
     def add_dirs(parent, dirs):
-      for dir in dirs:
-        dir_id = dir[0]
+      # Ask for the subdirectories of all dirs on this level at once.
+      futures = [self.db.submit_subdirs_by_dir_id(dir[0]) for dir in dirs]
+      for dir, future in zip(dirs, futures):
         dir_path = dir[1]
         directories.append(dir_path)
         iter = self.directory_iters.get(dir_path, None)
@@ -846,7 +887,7 @@ class MethLabWindow:
           else:
             self.directories_model.set(iter, 0, os.path.split(dir_path[:-1])[-1], 1, dir_path)
           self.directory_iters[dir_path] = iter
-        add_dirs(iter, self.db.get_subdirs_by_dir_id(dir_id))
+        add_dirs(iter, future.result())
     
     def flush(iter):
       while True:
@@ -869,7 +910,7 @@ class MethLabWindow:
       gobject.source_remove(self.search_timeout_tag)
       self.search_timeout_tag = None
 
-  def run_search(self, query, callback = None):
+  def run_search(self, query, callback = None, chunk_size = None, token = None):
     self.unflash_search_entry()
     
     if not self.get_active_search_fields():
@@ -881,9 +922,9 @@ class MethLabWindow:
     
     try:
       if query[0] == '@':
-        results = self.db.query_tracks(query[1:], callback)
+        results = self.db.query_tracks(query[1:], callback, chunk_size, token = token)
       else:
-        results = self.db.search_tracks(query, callback)
+        results = self.db.search_tracks(query, callback, chunk_size, token = token)
     except QueryTranslatorException, e:
       self.flash_search_entry()
       return
@@ -895,46 +936,43 @@ class MethLabWindow:
     if self.inhibit_search:
       return
 
-    self.tvResults.set_model(self.build_results_model())
+    results_model = self.build_results_model()
+    self.results_model = results_model
+    self.tvResults.set_model(results_model)
     self.tvResults.set_sensitive(True)
     
     query = self.entSearch.get_text()
     
-    self.run_search(query, self.search_callback)
+    # Cancels the previous search if it is still queued or running.
+    token = self.db.new_search_token()
+    self.run_search(query, lambda msg: self.search_callback(msg, results_model), self.SEARCH_CHUNK_SIZE, token)
     
     if add_to_history:
       self.add_to_history(query)
 
-  def search_callback(self, msg):
+  # Called (from the database thread) for every chunk of search results.
+  # Returning False stops the database from fetching the rest of the
+  # results of a search that has been superseded.
+  def search_callback(self, msg, results_model):
+    if results_model is not self.results_model:
+      return False
+
     results = msg.result
     if results is None:
       gobject.idle_add(self.flash_search_entry)
       return
     
-    results_model = self.build_results_model()
-    have_results = False
-    for result in results:
-      have_results = True
-      iter = results_model.append()
-      results_model.set(iter,
-        0, result['path'],
-        1, result['artist'],
-        2, result['album'],
-        3, result['track'],
-        4, result['title'],
-        5, result['year'],
-        6, result['genre'],
-        7, result['comment']
-      )
-    gobject.idle_add(self.search_callback_sync, have_results, results_model)
-
-  def search_callback_sync(self, have_results, results_model):
-    if not have_results:
+    rows = [(result['path'], result['artist'], result['album'], result['track'], result['title'], result['year'], result['genre'], result['comment']) for result in results]
+    gobject.idle_add(self.search_callback_sync, results_model, rows, msg.done)
+
+  def search_callback_sync(self, results_model, rows, done):
+    if results_model is not self.results_model:
+      return
+    for row in rows:
+      results_model.append(row)
+    if done and not len(results_model):
       self.tvResults.set_model(self.no_results_model)
       self.tvResults.set_sensitive(False)
-    else:
-      self.tvResults.set_model(results_model)
-      self.tvResults.set_sensitive(True)
 
   def cancel_flash_search_entry(self):
     if self.flash_timeout_tag is not None:
@@ -951,6 +989,24 @@ class MethLabWindow:
     self.entSearch.modify_base(gtk.STATE_NORMAL, None)
     return False
 
+  def watch_signals(self):
+    try:
+      import fcntl
+    except ImportError:
+      return
+    read_fd, write_fd = os.pipe()
+    for fd in (read_fd, write_fd):
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(write_fd)
+    gobject.io_add_watch(read_fd, gobject.IO_IN, self.on_signal_wakeup)
+
+  def on_signal_wakeup(self, fd, condition):
+    try:
+      os.read(fd, 64)
+    except OSError:
+      pass
+    return True
+
   def get_selected_result_iters(self):
     if self.tvResults.get_model() == self.no_results_model:
       return None, []
@@ -1152,20 +1208,35 @@ class MethLabWindow:
     if not paths:
       return
 
-    queries = []
+    # The selected artists and albums become sets: one IN for the artists,
+    # one for the albums of every other artist (or for all albums).
+    search_on_artist = self.config.getboolean('options', 'search_on_artist_and_album')
+    artists = []
+    albums = []
+    album_artists = []
+    artist_albums = {}
     for path in paths:
       iter = model.get_iter(path)
       parent = model.iter_parent(iter)
       if parent is None:
-        artist = query_escape(model.get_value(iter, 0))
-        queries.append('(artist = %s)' % artist)
+        artists.append(query_escape(model.get_value(iter, 0)))
+      elif search_on_artist:
+        artist = query_escape(model.get_value(parent, 0))
+        if not artist in artist_albums:
+          artist_albums[artist] = []
+          album_artists.append(artist)
+        artist_albums[artist].append(query_escape(model.get_value(iter, 0)))
       else:
-        album = query_escape(model.get_value(iter, 0))
-        if self.config.getboolean('options', 'search_on_artist_and_album'):
-          artist = query_escape(model.get_value(parent, 0))
-          queries.append('(artist = %s AND album = %s)' % (artist, album))
-        else:
-          queries.append('(album = %s)' % album)
+        albums.append(query_escape(model.get_value(iter, 0)))
+
+    queries = []
+    if artists:
+      queries.append('artist IN (%s)' % ', '.join(artists))
+    for artist in album_artists:
+      if not artist in artists:
+        queries.append('(artist = %s AND album IN (%s))' % (artist, ', '.join(artist_albums[artist])))
+    if albums:
+      queries.append('album IN (%s)' % ', '.join(albums))
     return '@' + ' OR '.join(queries)
   
   def on_artists_albums_selection_changed(self, selection):
@@ -1192,11 +1263,17 @@ class MethLabWindow:
     if not paths:
       return
 
+    # A selected directory below another selected one adds nothing. Sorted,
+    # the directories below a directory follow it, so only the last one
+    # kept has to be checked.
+    dirs = sorted([model.get_value(model.get_iter(path), 1) for path in paths])
     queries = []
-    for path in paths:
-      iter = model.get_iter(path)
-      dir = query_escape(model.get_value(iter, 1))
-      queries.append('(dir = %s)' % dir)
+    parent = None
+    for dir in dirs:
+      if parent is not None and dir.startswith(parent):
+        continue
+      parent = dir
+      queries.append('dir UNDER %s' % query_escape(dir))
     
     return '@' + ' OR '.join(queries)
 
@@ -1296,6 +1373,7 @@ class MethLabWindow:
     if self.inhibit_search:
       return
     text = editable.get_text()
+    self.update_match_count(text)
     if not text:
       self.search()
       return
@@ -1303,6 +1381,39 @@ class MethLabWindow:
       return
     self.search_timeout_tag = gobject.timeout_add(500, self.on_search_timeout)
 
+  # Show how many tracks match while typing, the results themselves are
+  # only fetched once typing pauses. Counting stops at COUNT_CAP matches.
+  def update_match_count(self, text):
+    token = self.db.new_count_token()
+    if not text or not self.get_active_search_fields():
+      self.show_match_count(text, None)
+      return
+    callback = lambda result: gobject.idle_add(self.show_match_count, text, result)
+    try:
+      if text[0] == '@':
+        self.db.count_tracks(text[1:], callback, self.COUNT_CAP, token)
+      else:
+        self.db.count_search(text, callback, self.COUNT_CAP, token)
+    except QueryTranslatorException, e:
+      # Most likely a query that is still being typed
+      self.show_match_count(text, None)
+
+  def show_match_count(self, text, result):
+    if text != self.entSearch.get_text():
+      return False
+    context_id = self.statusbar.get_context_id("matches")
+    if not self.count_message_id is None:
+      self.statusbar.remove(context_id, self.count_message_id)
+      self.count_message_id = None
+    if result is not None:
+      count, exact = result
+      if exact:
+        message = _('%(count)i matching tracks') % { 'count': count }
+      else:
+        message = _('More than %(count)i matching tracks') % { 'count': count }
+      self.count_message_id = self.statusbar.push(context_id, message)
+    return False
+
   def on_search_timeout(self):
     self.search_timeout_tag = None
     self.search(True)
@@ -1518,8 +1629,7 @@ class MethLabWindow:
       value = model.get_value(iter, col_id)
       if not value in values:
         values.append(value)
-    queries = ['(%s = %s)' % (field, query_escape(str(value))) for value in values]
-    query = '@' + ' OR '.join(queries)
+    query = '@%s IN (%s)' % (field, ', '.join([query_escape(str(value)) for value in values]))
     self.entSearch.set_text(query)
     self.search()
 
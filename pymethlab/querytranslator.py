@@ -15,25 +15,176 @@
 #  along with this program; if not, write to the Free Software
 #  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-__all__ = ['QueryTranslatorException', 'translate_query']
+__all__ = ['QueryTranslatorException', 'Comparison', 'Not', 'Junction', 'QueryCache', 'optimize', 'parse_query', 'translate_query', 'get_prefix_range']
 
+import re
+import sys
 import string
+import threading
 from gettext import gettext as _
 
+try:
+  import sqlite3 as sqlite
+except ImportError:
+  from pysqlite2 import dbapi2 as sqlite
+
 class QueryTranslatorException(Exception):
   pass
 
+# The nodes of a parsed query. A Comparison has the field, the query
+# operator and its values (one value, the bounds of the range for UNDER and
+# BETWEEN or the set for IN), a Junction has 'AND' or 'OR' and two or more
+# operands.
+class Comparison:
+  def __init__(self, field, operator, values):
+    self.field = field
+    self.operator = operator
+    self.values = values
+
+class Not:
+  def __init__(self, operand):
+    self.operand = operand
+
+class Junction:
+  def __init__(self, operator, operands):
+    self.operator = operator
+    self.operands = operands
+
+# The query is split into tokens in one pass by a single regular expression,
+# every match is a symbol, a quoted string (backslash escapes the next
+# character), a word or whitespace. A quote that does not start a complete
+# string is an unterminated one. The longer symbols come first in the
+# alternatives, so <= is not read as < followed by =.
+TOKEN_RE = re.compile(r'''
+  (?P<space>\s+)
+  | (?P<symbol>\(|\)|,|!=|<=|>=|=|<|>)
+  | "(?P<dstring>(?:[^"\\]|\\.)*)"
+  | '(?P<sstring>(?:[^'\\]|\\.)*)'
+  | (?P<unterminated>["'])
+  | (?P<word>(?:[^\s(),=<>!]|!(?!=))+)
+''', re.VERBOSE | re.DOTALL)
+ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+
+# The fields of track_info that hold text. Only on these a LIKE without
+# wildcards is the same as a NOCASE comparison, LIKE compares numbers as
+# text. IN compares text fields without case too.
+TEXT_FIELDS = ('path', 'dir', 'filename', 'album', 'artist', 'comment', 'genre', 'title')
+
+# The fields of track_info, the ones the results can be sorted by.
+TRACK_INFO_FIELDS = ('id', 'path', 'dir', 'dir_id', 'filename', 'mtime', 'album', 'artist', 'comment', 'genre', 'title', 'track', 'year')
+
+# LIKE and the NOCASE collation both fold ASCII letters only.
+ASCII_LOWER = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+UNICODE_LOWER = dict([(ord(upper), ord(lower)) for upper, lower in zip(string.ascii_uppercase, string.ascii_lowercase)])
+
+def ascii_lower(value):
+  if isinstance(value, unicode):
+    return value.translate(UNICODE_LOWER)
+  return value.translate(ASCII_LOWER)
+
+# Returns a key that is the same for equal (sub)queries.
+def get_key(node):
+  if isinstance(node, Comparison):
+    return (node.field.lower(), node.operator, node.values)
+  elif isinstance(node, Not):
+    return ('NOT', get_key(node.operand))
+  else:
+    return (node.operator, tuple([get_key(operand) for operand in node.operands]))
+
+def is_text_field(field):
+  return field.lower() in TEXT_FIELDS
+
+def has_wildcards(pattern):
+  return '%' in pattern or '_' in pattern
+
+# An exact match on a text field, that can be part of a set.
+def is_set_member(node):
+  if not isinstance(node, Comparison):
+    return False
+  if node.operator == 'IN':
+    return True
+  return node.operator == '=' and is_text_field(node.field) and not has_wildcards(node.values[0])
+
+# Merges the exact matches on the same field in an OR into one IN.
+def merge_sets(operands):
+  sets = {}
+  result = []
+  for operand in operands:
+    if not is_set_member(operand):
+      result.append(operand)
+      continue
+    field = operand.field.lower()
+    if not field in sets:
+      sets[field] = (len(result), [], set())
+      result.append(operand)
+    values, seen = sets[field][1:]
+    for value in operand.values:
+      if not value in seen:
+        seen.add(value)
+        values.append(value)
+  for field, (i, values, seen) in sets.items():
+    if len(values) > 1 or result[i].operator == 'IN':
+      result[i] = Comparison(result[i].field, 'IN', tuple(values))
+  return result
+
+# Simplifies a parsed query without changing its result, NULLs included:
+# double negations are dropped, nested junctions of the same kind are
+# merged, repeated operands are removed and an operand that contains
+# another operand of its junction is absorbed by it (a OR (a AND b) is a).
+# The artists / albums pane generates the latter when both an artist and
+# one of its albums are selected. Exact matches on the same field in an OR
+# become a single IN.
+def optimize(node):
+  if isinstance(node, Not):
+    operand = optimize(node.operand)
+    if isinstance(operand, Not):
+      return operand.operand
+    return Not(operand)
+  elif isinstance(node, Junction):
+    operands = []
+    for operand in node.operands:
+      operand = optimize(operand)
+      if isinstance(operand, Junction) and operand.operator == node.operator:
+        operands.extend(operand.operands)
+      else:
+        operands.append(operand)
+    keys = set()
+    unique = []
+    for operand in operands:
+      key = get_key(operand)
+      if not key in keys:
+        keys.add(key)
+        unique.append(operand)
+    operands = [operand for operand in unique if not (isinstance(operand, Junction) and [key for key in map(get_key, operand.operands) if key in keys])]
+    if node.operator == 'OR':
+      operands = merge_sets(operands)
+    if len(operands) == 1:
+      return operands[0]
+    return Junction(node.operator, operands)
+  return node
+
 class QueryTranslator:
-  # Note about symbol order: when defining combined operators like <= where
-  # that start with a different operator (like <), make sure the longest one
-  # is first in the symbol list
-  SYMBOLS = ('(', ')', '=', '!=', '<=', '<', '>=', '>')
-  KEYWORDS = ('AND', 'OR')
+  SYMBOLS = ('(', ')', ',', '=', '!=', '<=', '<', '>=', '>')
+  KEYWORDS = ('AND', 'OR', 'UNDER')
+  # The operators a field can be compared with, and the SQL operators of
+  # the ones that are translated to one.
+  COMPARISONS = ('=', '!=', '<', '<=', '>', '>=', 'UNDER', 'IN', 'BETWEEN')
+  OPERATORS = { '=': 'LIKE', '!=': 'NOT LIKE' }
+  # The number of variables a statement can have: 999 before SQLite 3.32,
+  # 32766 since. Two of them are left for the LIMIT and OFFSET of a page.
+  if sqlite.sqlite_version_info >= (3, 32, 0):
+    MAX_VARIABLES = 32766 - 2
+  else:
+    MAX_VARIABLES = 999 - 2
 
   def __init__(self):
     self.query = None
+    self.tree = None
     self.sql_query = None
     self.sql_symbols = None
+    self.terms = None
+    self.order = ()
+    self.limit = None
 
   def is_safe(self, token):
     for c in token:
@@ -41,129 +192,349 @@ class QueryTranslator:
         return False
     return True
 
+  # Parses the query into self.tree (None for an empty query, which matches
+  # all tracks), and compiles it to SQL and to the list of terms the mirror
+  # evaluates. The fields of a trailing ORDER BY end up in self.order
+  # ('field' or 'field DESC'), the number of a trailing LIMIT in
+  # self.limit. The query can be just those.
   def parse(self, query):
     self.query = query
-    self.sql_query = ''
-    self.sql_symbols = []
-
-    level = 0
-    state = 0
-    while self.query:
-      token = self.get_token()
-      if token is None:
-        continue
+    self.tokens = self.tokenize(query)
+    self.pos = 0
+    self.tree = None
+    self.order = ()
+    self.limit = None
+    if self.tokens:
+      if not self.peek() in (('word', 'ORDER'), ('word', 'LIMIT')):
+        try:
+          self.tree = optimize(self.parse_or())
+        except RuntimeError:
+          raise QueryTranslatorException(_('Query is nested too deeply'))
+      self.parse_order()
+      self.parse_limit()
+      if self.pos < len(self.tokens):
+        if self.tokens[self.pos] == ('symbol', ')'):
+          raise QueryTranslatorException(_("Unbalanced ')' character"))
+        self.unexpected(self.tokens[self.pos])
+    self.tokens = None
 
-      if state == 0:
-        if token == '(':
-          level += 1
-          self.sql_query += '('
-        elif token == 'NOT':
-          self.sql_query += 'NOT '
-        elif token in self.SYMBOLS:
-          raise QueryTranslatorException(_('Unexpected symbol %(symbol)s') % { 'symbol': token })
-        elif token in self.KEYWORDS:
-          raise QueryTranslatorException(_('Unexpected keyword %(keyword)s') % { 'keyword': token })
-        else:
-          if not self.is_safe(token):
-            raise QueryTranslatorException(_('Unsafe field %(field)s') % { 'field': token })
-          self.sql_query += token
-          state = 1
-
-      elif state == 1:
-        if token == '=':
-          self.sql_query += ' LIKE ?'
-        elif token == '!=':
-          self.sql_query += ' NOT LIKE ?'
-        elif token in ('<', '<=', '>', '>='):
-          self.sql_query += ' %s ?' % token
-        elif token in self.SYMBOLS:
-          raise QueryTranslatorException(_('Unexpected symbol %(symbol)s') % { 'symbol': token })
-        elif token in self.KEYWORDS:
-          raise QueryTranslatorException(_('Unexpected keyword %(keyword)s') % { 'keyword': token })
-        else:
-          raise QueryTranslatorException(_('Unexpected string %(string)s') % { 'string': token })
-        state = 2
-
-      elif state == 2:
-        if token in self.SYMBOLS:
-          raise QueryTranslatorException(_('Unexpected symbol %(symbol)s') % { 'symbol': token })
-        elif token in self.KEYWORDS:
-          raise QueryTranslatorException(_('Unexpected keyword %(keyword)s') % { 'keyword': token })
-        self.sql_symbols.append(token)
-        state = 3
-
-      elif state == 3:
-        if token in ('AND', 'OR'):
-          self.sql_query += ' ' + token + ' '
-          state = 0
-        elif token == ')':
-          level -= 1
-          state = 3
-          self.sql_query += ')'
-        elif token in self.SYMBOLS:
-          raise QueryTranslatorException(_('Unexpected symbol %(symbol)s') % { 'symbol': token })
-        elif token in self.KEYWORDS:
-          raise QueryTranslatorException(_('Unexpected keyword %(keyword)s') % { 'keyword': token })
-        else:
-          raise QueryTranslatorException(_('Unexpected string %(string)s') % { 'string': token })
-
-    if level > 0:
-      raise QueryTranslatorException(_("Unbalanced '(' character"))
-    elif level < 0:
-      raise QueryTranslatorException(_("Unbalanced ')' character"))
-
-  def get_token(self):
-    if not self.query:
-      return None
-
-    c = self.query[0]
-
-    if c == ' ':
-      self.query = self.query[1:]
-      return None
-
-    for symbol in self.SYMBOLS:
-      if self.query[:len(symbol)] == symbol:
-        self.query = self.query[len(symbol):]
-        return symbol
-
-    if c in ('"', "'"):
-      return self.get_string_token()
+    symbols = []
+    if self.tree is None:
+      self.sql_query = '1'
+      self.terms = []
     else:
-      return self.get_word_token()
-
-  def get_string_token(self):
-    quote = self.query[0]
-
-    self.query = self.query[1:]
-    if not self.query:
-      raise QueryTranslatorException(_('Unterminated string near end of query'))
-
-    token = ''
-    escape = False
-    while not (self.query[0] == quote and not escape):
-      c = self.query[0]
-      if escape:
-        token += c
-        escape = False
-      elif c == '\\':
-        escape = True
-      else:
-        token += c
-      self.query = self.query[1:]
-      if not self.query:
+      self.sql_query = self.compile(self.tree, symbols)
+      self.terms = self.get_terms(self.tree)
+    if len(symbols) > self.MAX_VARIABLES:
+      raise QueryTranslatorException(_('Query has too many values (%(count)i, at most %(max)i are allowed)') % { 'count': len(symbols), 'max': self.MAX_VARIABLES })
+    self.sql_symbols = tuple(symbols)
+
+  # Returns the (kind, value) tokens of the query, kind being 'symbol',
+  # 'string' or 'word'. Only words can be keywords.
+  def tokenize(self, query):
+    tokens = []
+    pos = 0
+    while pos < len(query):
+      match = TOKEN_RE.match(query, pos)
+      pos = match.end()
+      kind = match.lastgroup
+      if kind == 'space':
+        continue
+      elif kind == 'unterminated':
         raise QueryTranslatorException(_('Unterminated string near end of query'))
-    self.query = self.query[1:]
-    return token
+      elif kind in ('dstring', 'sstring'):
+        tokens.append(('string', ESCAPE_RE.sub(r'\1', match.group(kind))))
+      else:
+        tokens.append((kind, match.group(kind)))
+    return tokens
+
+  def peek(self):
+    if self.pos < len(self.tokens):
+      return self.tokens[self.pos]
+    return None
 
-  def get_word_token(self):
-    token = ''
-    while self.query and not self.query[0] in self.SYMBOLS + (' ', ):
-      token += self.query[0]
-      self.query = self.query[1:]
+  def next(self):
+    token = self.peek()
+    if token is None:
+      raise QueryTranslatorException(_('Unexpected end of query'))
+    self.pos += 1
     return token
 
+  def expect(self, expected):
+    token = self.next()
+    if token != expected:
+      self.unexpected(token)
+
+  def unexpected(self, token):
+    kind, value = token
+    if kind == 'symbol':
+      raise QueryTranslatorException(_('Unexpected symbol %(symbol)s') % { 'symbol': value })
+    elif kind == 'word' and value in self.KEYWORDS:
+      raise QueryTranslatorException(_('Unexpected keyword %(keyword)s') % { 'keyword': value })
+    else:
+      raise QueryTranslatorException(_('Unexpected string %(string)s') % { 'string': value })
+
+  # Recursive descent with SQL's precedence: NOT binds tighter than AND,
+  # which binds tighter than OR.
+  def parse_or(self):
+    return self.parse_junction('OR', self.parse_and)
+
+  def parse_and(self):
+    return self.parse_junction('AND', self.parse_not)
+
+  def parse_junction(self, operator, parse_operand):
+    operands = [parse_operand()]
+    while self.peek() == ('word', operator):
+      self.pos += 1
+      operands.append(parse_operand())
+    if len(operands) == 1:
+      return operands[0]
+    return Junction(operator, operands)
+
+  def parse_not(self):
+    if self.peek() == ('word', 'NOT'):
+      self.pos += 1
+      return Not(self.parse_not())
+    return self.parse_primary()
+
+  def parse_primary(self):
+    token = self.next()
+    if token == ('symbol', '('):
+      node = self.parse_or()
+      if self.peek() != ('symbol', ')'):
+        if self.peek() is None:
+          raise QueryTranslatorException(_("Unbalanced '(' character"))
+        self.unexpected(self.peek())
+      self.pos += 1
+      return node
+
+    field = self.parse_field(token)
+    token = self.next()
+    kind, operator = token
+    if kind == 'string' or not operator in self.COMPARISONS:
+      self.unexpected(token)
+
+    if operator == 'IN':
+      self.expect(('symbol', '('))
+      values = [self.parse_value()]
+      while self.peek() == ('symbol', ','):
+        self.pos += 1
+        values.append(self.parse_value())
+      self.expect(('symbol', ')'))
+      return Comparison(field, operator, tuple(values))
+
+    value = self.parse_value()
+    if operator == 'BETWEEN':
+      self.expect(('word', 'AND'))
+      values = (value, self.parse_value())
+    elif operator == 'UNDER':
+      if not value:
+        raise QueryTranslatorException(_('Empty prefix for %(field)s UNDER') % { 'field': field })
+      values = get_prefix_range(value)
+    else:
+      values = (value, )
+    return Comparison(field, operator, values)
+
+  def parse_field(self, token):
+    kind, field = token
+    if kind == 'symbol' or (kind == 'word' and field in self.KEYWORDS):
+      self.unexpected(token)
+    if not self.is_safe(field):
+      raise QueryTranslatorException(_('Unsafe field %(field)s') % { 'field': field })
+    return field
+
+  def parse_value(self):
+    token = self.next()
+    kind, value = token
+    if kind == 'symbol' or (kind == 'word' and value in self.KEYWORDS):
+      self.unexpected(token)
+    return value
+
+  # ORDER BY field [ASC | DESC], ... replaces the sort order of the results.
+  def parse_order(self):
+    if self.peek() != ('word', 'ORDER'):
+      return
+    self.pos += 1
+    self.expect(('word', 'BY'))
+    order = []
+    while 1:
+      field = self.parse_field(self.next()).lower()
+      if not field in TRACK_INFO_FIELDS:
+        raise QueryTranslatorException(_('Unknown sort field %(field)s') % { 'field': field })
+      if self.peek() in (('word', 'ASC'), ('word', 'DESC')):
+        field += ' ' + self.next()[1]
+      order.append(field)
+      if self.peek() != ('symbol', ','):
+        break
+      self.pos += 1
+    self.order = tuple(order)
+
+  def parse_limit(self):
+    if self.peek() != ('word', 'LIMIT'):
+      return
+    self.pos += 1
+    kind, value = self.next()
+    if kind != 'word' or not value.isdigit():
+      raise QueryTranslatorException(_('Invalid limit %(limit)s') % { 'limit': value })
+    self.limit = int(value)
+
+  # Returns the SQL of a node, appending its symbols. Nested junctions of
+  # the other kind and negated junctions get parentheses.
+  def compile(self, node, symbols):
+    if isinstance(node, Comparison):
+      if node.operator in ('=', '!=') and is_text_field(node.field):
+        return self.compile_like(node, symbols)
+      if node.operator == 'IN':
+        return self.compile_set(node, symbols)
+      if node.operator == 'UNDER':
+        # A (case sensitive) prefix match that can use an index on the
+        # field, unlike LIKE: dir UNDER '/music/' matches every track in
+        # and below /music/.
+        low, high = node.values
+        symbols.append(low)
+        if high is None:
+          return '%s >= ?' % node.field
+        symbols.append(high)
+        return '(%s >= ? AND %s < ?)' % (node.field, node.field)
+      symbols.extend(node.values)
+      if node.operator == 'BETWEEN':
+        return '%s BETWEEN ? AND ?' % node.field
+      return '%s %s ?' % (node.field, self.OPERATORS.get(node.operator, node.operator))
+    elif isinstance(node, Not):
+      return 'NOT ' + self.compile_operand(node.operand, None, symbols)
+    else:
+      return (' %s ' % node.operator).join([self.compile_operand(operand, node.operator, symbols) for operand in node.operands])
+
+  # SQLite can not use an index for LIKE with a bound pattern, so a pattern
+  # without wildcards is compiled to a NOCASE comparison (the advisor's
+  # indexes are NOCASE) and a pattern that only ends in % to a range scan
+  # over the ASCII lower case prefix. Anything else stays a LIKE.
+  def compile_like(self, node, symbols):
+    field = node.field
+    pattern = node.values[0]
+    negate = node.operator == '!='
+    if not has_wildcards(pattern):
+      symbols.append(pattern)
+      if negate:
+        return '%s <> ? COLLATE NOCASE' % field
+      return '%s = ? COLLATE NOCASE' % field
+
+    prefix = pattern.rstrip('%')
+    # The upper bound is the prefix with its last character incremented,
+    # that must not end up an upper case letter (or out of range).
+    if not has_wildcards(prefix) and not (prefix and (prefix[-1] == '@' or ord(prefix[-1]) >= get_max_char(prefix))):
+      prefix = ascii_lower(prefix)
+      if prefix:
+        symbols.extend(get_prefix_range(prefix))
+        sql = '(%s >= ? COLLATE NOCASE AND %s < ? COLLATE NOCASE)' % (field, field)
+      else:
+        symbols.append(prefix)
+        sql = '%s >= ? COLLATE NOCASE' % field
+      if negate:
+        return 'NOT ' + sql
+      return sql
+
+    symbols.append(pattern)
+    return '%s %s ?' % (field, self.OPERATORS[node.operator])
+
+  # Text fields are compared without case, like =, through the advisor's
+  # NOCASE indexes.
+  def compile_set(self, node, symbols):
+    field = node.field
+    if is_text_field(field):
+      field += ' COLLATE NOCASE'
+    symbols.extend(node.values)
+    return '%s IN (%s)' % (field, ', '.join(['?'] * len(node.values)))
+
+  def compile_operand(self, node, operator, symbols):
+    sql = self.compile(node, symbols)
+    if isinstance(node, Junction) and node.operator != operator:
+      sql = '(' + sql + ')'
+    return sql
+
+  def get_terms(self, node):
+    if isinstance(node, Comparison):
+      return [(node.field, self.OPERATORS.get(node.operator, node.operator), node.values)]
+    elif isinstance(node, Not):
+      return ['NOT'] + self.get_operand_terms(node.operand, None)
+    else:
+      terms = []
+      for operand in node.operands:
+        if terms:
+          terms.append(node.operator)
+        terms.extend(self.get_operand_terms(operand, node.operator))
+      return terms
+
+  def get_operand_terms(self, node, operator):
+    terms = self.get_terms(node)
+    if isinstance(node, Junction) and node.operator != operator:
+      terms = ['('] + terms + [')']
+    return terms
+
+# A least recently used cache of parsed queries, keyed by the query text.
+# The cached translators are shared, their results must not be changed.
+class QueryCache:
+  def __init__(self, max_entries = 256):
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.entries = {}
+    self.order = []
+
+  def get(self, query):
+    self.lock.acquire()
+    result = self.entries.get(query, None)
+    if result is not None:
+      self.order.remove(query)
+      self.order.append(query)
+    self.lock.release()
+    return result
+
+  def put(self, query, translator):
+    self.lock.acquire()
+    if not query in self.entries:
+      self.entries[query] = translator
+      self.order.append(query)
+      while len(self.order) > self.max_entries:
+        del self.entries[self.order.pop(0)]
+    self.lock.release()
+
+_cache = QueryCache()
+
+# Returns the translator after parsing the query. Besides the SQL it has the
+# query as a tree of Comparison, Not and Junction nodes, and as a list of
+# terms: '(', ')', 'NOT', 'AND', 'OR' and a (field, operator, values) tuple
+# for every comparison, with the SQL operators LIKE, NOT LIKE, <, <=, >, >=,
+# UNDER, IN and BETWEEN. Running a query again (from the history, or a saved search)
+# takes the translator from the cache instead of parsing the query again.
+def parse_query(query):
+  t = _cache.get(query)
+  if t is None:
+    t = QueryTranslator()
+    t.parse(query)
+    _cache.put(query, t)
+  return t
+
 def translate_query(query):
-  t = QueryTranslator()
-  t.parse(query)
+  t = parse_query(query)
   return t.sql_query, tuple(t.sql_symbols)
+
+# Returns the bounds of the strings starting with prefix, so a prefix match
+# can be done as a range scan (value >= low AND value < high) over an index.
+# The upper bound is the prefix without its trailing highest characters,
+# with the last character left incremented. It is None when the prefix is
+# made of highest characters only: every string from it on starts with it.
+def get_prefix_range(prefix):
+  max_char = get_max_char(prefix)
+  high = prefix
+  while high and ord(high[-1]) >= max_char:
+    high = high[:-1]
+  if not high:
+    return prefix, None
+  if isinstance(prefix, unicode):
+    return prefix, high[:-1] + unichr(ord(high[-1]) + 1)
+  return prefix, high[:-1] + chr(ord(high[-1]) + 1)
+
+def get_max_char(value):
+  if isinstance(value, unicode):
+    return sys.maxunicode
+  return 0xff
@@ -0,0 +1,167 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+__all__ = ['SEARCH_FIELDS', 'parse_search', 'is_refinement', 'translate_search', 'translate_fts_search']
+
+import re
+
+from querytranslator import ascii_lower
+
+# The fields a term can be qualified with (field:term).
+SEARCH_FIELDS = ('path', 'album', 'artist', 'comment', 'genre', 'title', 'track', 'year')
+
+# The trigram tokenizer only finds substrings of at least three characters.
+# It folds the case of all letters where LIKE only folds ASCII, so terms
+# with non ASCII characters (bytes >= 0x80) are left to LIKE, as are terms
+# with LIKE wildcards.
+MIN_FTS_TERM = 3
+_fts_term_re = re.compile('^[^\\x80-\\xff%_]*$')
+
+# A | between clauses, or a term: an optional - (negation), an optional
+# field: qualifier and a "quoted phrase" (the closing quote may be left
+# out) or a word. A - or field: without a term after it is a word itself.
+_term_re = re.compile(r'\s*(?:(\|)|(-)?(?:([A-Za-z]+):)?(?:"([^"]*)"?|([^\s|]+)))')
+
+# Chop up the query into clauses of terms. Each term is a (field, text,
+# negate) tuple, with field None for a term that matches any of the
+# search fields:
+# a -b | c:"d e" --> [[a, -b], [c:d e]] --> (a AND NOT b) OR (d e in c)
+def parse_search(query):
+  clauses = []
+  clause = []
+  pos = 0
+  query = query.rstrip()
+  while pos < len(query):
+    match = _term_re.match(query, pos)
+    pos = match.end()
+    bar, negate, field, phrase, word = match.groups()
+    if bar:
+      if clause:
+        clauses.append(clause)
+      clause = []
+      continue
+    text = phrase
+    if text is None:
+      text = word
+    if field is not None and not field.lower() in SEARCH_FIELDS:
+      text = field + ':' + text
+      field = None
+    elif field is not None:
+      field = field.lower()
+    if text:
+      clause.append((field, text, bool(negate)))
+  if clause:
+    clauses.append(clause)
+  return clauses
+
+# A term implies another one on the same field when it only matches tracks
+# the other one matches as well: a substring match of beatles is a
+# substring match of beat, and excluding beat excludes beatles.
+def implies(term, other):
+  field, text, negate = term
+  other_field, other_text, other_negate = other
+  if field != other_field or negate != other_negate:
+    return False
+  if negate:
+    return ascii_lower(text) in ascii_lower(other_text)
+  return ascii_lower(other_text) in ascii_lower(text)
+
+# A search is a refinement of another one when every track it matches is
+# matched by the other one as well: each of its clauses implies one of the
+# other search's clauses. A clause implies another one when each term of
+# the other one is implied by one of its terms.
+def is_refinement(old_clauses, new_clauses):
+  if not old_clauses or not new_clauses:
+    return False
+  for new_clause in new_clauses:
+    for old_clause in old_clauses:
+      for old_term in old_clause:
+        if not [new_term for new_term in new_clause if implies(new_term, old_term)]:
+          break
+      else:
+        break
+    else:
+      return False
+  return True
+
+# Translate a parsed search to a WHERE clause matching each term against
+# every search field (or the field it is qualified with) separately. A
+# negated term also holds when the fields are NULL.
+def translate_search(clauses, fields):
+  sql_clauses = []
+  symbols = []
+  for clause in clauses:
+    sql_terms = []
+    for field, text, negate in clause:
+      if field is not None:
+        term_fields = [field]
+      else:
+        term_fields = fields
+      sql_term = ' OR '.join(['%s LIKE ?' % term_field for term_field in term_fields]) or '0'
+      symbols += ['%%%s%%' % text] * len(term_fields)
+      if negate:
+        sql_term = '(%s) IS NOT 1' % sql_term
+      elif len(term_fields) > 1:
+        sql_term = '(%s)' % sql_term
+      sql_terms.append(sql_term)
+    sql_clauses.append(' AND '.join(sql_terms))
+  if not sql_clauses:
+    return '0', ()
+  return '(' + ') OR ('.join(sql_clauses) + ')', tuple(symbols)
+
+def translate_fts_term(fields, term):
+  query = 'SELECT rowid FROM tracks_fts WHERE tracks_fts MATCH ?'
+  symbol = '{%s} : "%s"' % (' '.join(fields), term.replace('"', '""'))
+  return query, [symbol]
+
+# Translate a parsed search to a compound SELECT returning the OIDs of the
+# matching tracks from the full-text index. The index is built with the
+# trigram tokenizer, so every term is a substring match in the given fields
+# (or the field it is qualified with, the index has a column for each of
+# SEARCH_FIELDS) exactly like translate_search, negated terms are taken out
+# of the matches of the others. Returns None for the query if the search
+# can not be expressed as a full-text lookup.
+def translate_fts_search(clauses, fields):
+  if not clauses:
+    return None, ()
+
+  sql_clauses = []
+  symbols = []
+  for clause in clauses:
+    # Negated terms go last, SQLite evaluates compound SELECTs left to
+    # right.
+    clause = [term for term in clause if not term[2]] + [term for term in clause if term[2]]
+    if clause[0][2]:
+      return None, ()
+    sql_terms = []
+    for field, text, negate in clause:
+      if field is not None:
+        term_fields = [field]
+      else:
+        term_fields = fields
+      if not term_fields or len(text) < MIN_FTS_TERM or not _fts_term_re.match(text):
+        return None, ()
+      query, term_symbols = translate_fts_term(term_fields, text)
+      if sql_terms and negate:
+        sql_terms.append('EXCEPT SELECT * FROM (%s)' % query)
+      elif sql_terms:
+        sql_terms.append('INTERSECT SELECT * FROM (%s)' % query)
+      else:
+        sql_terms.append('SELECT * FROM (%s)' % query)
+      symbols += term_symbols
+    sql_clauses.append('SELECT * FROM (%s)' % ' '.join(sql_terms))
+  return ' UNION '.join(sql_clauses), tuple(symbols)
@@ -19,6 +19,8 @@ __all__ = ['UpdateHelper']
 
 import threading
 
+from dbscheduler import set_thread_priority, PRIORITY_BULK
+
 class UpdateHelper:
   def __init__(self, db, scanner_class):
     self.db = db
@@ -45,6 +47,8 @@ class UpdateHelper:
   
   def update(self, callback):
     def run_scanner():
+      # Let queries from the GUI go ahead of the scanner's writes.
+      set_thread_priority(PRIORITY_BULK)
       self.scanner.update()
       self.lock.acquire()
       self.scanner = None
@@ -0,0 +1,152 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pymethlab'))
+
+from db import *
+from db import DBToken
+from dbindexes import advise_indexes
+from dbqueries import SchemaIndexes
+
+# A query that runs for a long time (counting to a billion).
+LongQuery = '''
+WITH RECURSIVE counter(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM counter WHERE n < 1000000000)
+SELECT count(*) FROM counter'''
+
+class DBTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    # Without readers, a message waits for the ones queued before it.
+    self.db = DBThread(os.path.join(self.dir, 'methlab.db'), readers = 0, maintenance_budget = None)
+    self.db.start()
+
+  def tearDown(self):
+    self.db.stop()
+    self.db.join()
+    shutil.rmtree(self.dir)
+
+  # A running query is interrupted through the progress handler.
+  def test_cancel_running(self):
+    token = DBToken()
+    future = self.db.submitread(LongQuery, token = token)
+    time.sleep(0.2)
+    self.assert_(not future.done())
+    start = time.time()
+    token.cancel()
+    self.assertEqual(future.result(), None)
+    self.assert_(future.cancelled())
+    self.assert_(time.time() - start < 2)
+
+  # A queued query is dropped, its callback is never called.
+  def test_cancel_queued(self):
+    blocker = DBToken()
+    self.db.submitread(LongQuery, token = blocker)
+    token = DBToken()
+    called = []
+    self.db.executereadasync('SELECT 1', callback = called.append, token = token)
+    future = self.db.submitread('SELECT 1', token = token)
+    token.cancel()
+    blocker.cancel()
+    self.assertEqual(future.result(), None)
+    self.assert_(future.cancelled())
+    self.assertEqual(called, [])
+
+  def test_not_cancelled(self):
+    future = self.db.submitread('SELECT 1', token = DBToken())
+    self.assertEqual([tuple(row) for row in future.result()], [(1, )])
+    self.assert_(not future.cancelled())
+
+class StopTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  # Stopping waits for the index advisor and maintenance timers, and a pass
+  # starting after it queues nothing.
+  def test_stop_timers(self):
+    db = DBThread(os.path.join(self.dir, 'methlab.db'))
+    db.start()
+    db.schedule_maintenance(0)
+    timers = [timer for timer in (db.index_timer, db.maintenance_timer) if timer]
+    self.assertEqual(len(timers), 2)
+    db.stop()
+    db.join()
+    for timer in timers:
+      self.assert_(not timer.isAlive())
+    # The passes set the priority of the thread they run on.
+    for function in (db.update_indexes, db.run_maintenance, db.schedule_update_indexes):
+      thread = threading.Thread(target = function)
+      thread.start()
+      thread.join()
+    self.assertEqual((db.queue.qsize(), db.index_timer, db.maintenance_timer), (0, None, None))
+
+class IndexTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.db = DBThread(os.path.join(self.dir, 'methlab.db'), readers = 0, maintenance_budget = None)
+    self.db.start()
+
+  def tearDown(self):
+    self.db.stop()
+    self.db.join()
+    shutil.rmtree(self.dir)
+
+  # The passes set the priority of the thread they run on.
+  def update_indexes(self):
+    thread = threading.Thread(target = self.db.update_indexes)
+    thread.start()
+    thread.join()
+
+  def test_reasons(self):
+    self.update_indexes()
+    reasons = dict([(name, (table, reason)) for name, table, reason in self.db.get_indexes()])
+    for table in ('artists', 'albums', 'genres'):
+      self.assertEqual(reasons['sqlite_autoindex_%s_1' % table], (table, 'unique constraint'))
+    for table in ('dirs', 'tracks'):
+      self.assertEqual(reasons['sqlite_autoindex_%s_1' % table], (table, 'primary key'))
+    for name in SchemaIndexes:
+      self.assertEqual(reasons[name][1], 'schema')
+    advised = advise_indexes(self.db.sort_order, self.db.search_fields)
+    self.assert_(advised)
+    for name, (query, reason) in advised.items():
+      self.assertEqual(reasons[name][1], reason)
+
+  # An index that could not be built is not recorded, the next update
+  # tries again.
+  def test_failed_index(self):
+    advised = advise_indexes(self.db.sort_order, self.db.search_fields)
+    name = advised.keys()[0]
+    self.db.execute('CREATE TABLE %s (id INTEGER)' % name)
+    self.update_indexes()
+    self.assert_(not name in self.db.indexes)
+    self.assertEqual([index for index in self.db.get_indexes() if index[0] == name], [])
+    self.db.execute('DROP TABLE %s' % name)
+    self.update_indexes()
+    self.assertEqual(self.db.indexes[name], advised[name][1])
+
+if __name__ == '__main__':
+  unittest.main()
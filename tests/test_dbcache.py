@@ -0,0 +1,104 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pymethlab'))
+
+from dbcache import *
+from db import *
+
+class CacheTest(unittest.TestCase):
+  def test_lru(self):
+    cache = DBResultCache(max_entries = 2)
+    cache.put('a', 0, [1])
+    cache.put('b', 0, [2])
+    cache.get('a', 0)
+    cache.put('c', 0, [3])
+    self.assertEqual((cache.get('a', 0), cache.get('b', 0), cache.get('c', 0)), ([1], None, [3]))
+
+  def test_max_rows(self):
+    cache = DBResultCache(max_rows = 3)
+    cache.put('a', 0, [1, 2])
+    cache.put('b', 0, [3, 4])
+    self.assertEqual((cache.get('a', 0), cache.get('b', 0)), (None, [3, 4]))
+    cache.put('c', 0, [5, 6, 7, 8])
+    self.assertEqual(cache.get('c', 0), None)
+    self.assertEqual(cache.get_stats()['rows'], 2)
+
+  def test_generation(self):
+    cache = DBResultCache()
+    cache.put('a', 0, [1])
+    self.assertEqual(cache.get('a', 1), None)
+    self.assertEqual(cache.get_stats()['entries'], 0)
+    # A result computed before a write is not stored after it.
+    cache.put('a', 0, [1])
+    self.assertEqual(cache.get('a', 1), None)
+    cache.put('a', 1, [2])
+    self.assertEqual(cache.get('a', 1), [2])
+
+  def test_not_shared(self):
+    cache = DBResultCache()
+    result = [1, 2]
+    cache.put('a', 0, result)
+    result.append(3)
+    cached = cache.get('a', 0)
+    self.assertEqual(cached, [1, 2])
+    cached.append(4)
+    self.assertEqual(cache.get('a', 0), [1, 2])
+    self.assert_(cache.get('a', 0) is not cache.get('a', 0))
+
+class Tag:
+  def __init__(self, title):
+    self.title = title
+    self.artist = self.album = self.genre = self.comment = None
+    self.track = self.year = None
+
+class DBCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.db = DBThread(os.path.join(self.dir, 'methlab.db'), maintenance_budget = None)
+    self.db.start()
+    self.root = self.db.get_dir_id(None, '/music/')
+    self.db.add_track(self.root, 'a.mp3', 1, Tag('a'))
+
+  def tearDown(self):
+    self.db.stop()
+    self.db.join()
+    shutil.rmtree(self.dir)
+
+  def query(self):
+    return [row['title'] for row in self.db.query_tracks('title != "x"')]
+
+  # Every write starts a new library generation, the next read misses.
+  def test_write_invalidates(self):
+    self.assertEqual(self.query(), ['a'])
+    misses = self.db.get_cache_stats()['misses']
+    self.assertEqual(self.query(), ['a'])
+    self.assertEqual(self.db.get_cache_stats()['misses'], misses)
+    self.db.add_track(self.root, 'b.mp3', 1, Tag('b'))
+    self.assertEqual(self.query(), ['a', 'b'])
+    self.assertEqual(self.db.get_cache_stats()['misses'], misses + 1)
+    self.db.delete_tracks([(self.root, 'a.mp3')])
+    self.assertEqual(self.query(), ['b'])
+
+if __name__ == '__main__':
+  unittest.main()
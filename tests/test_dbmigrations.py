@@ -0,0 +1,142 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import sys
+import unittest
+import sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pymethlab'))
+
+from dbqueries import *
+from dbmigrations import *
+from dbmigrations import get_column_names
+
+# The schemas of the versions before PRAGMA user_version: version 0 called
+# the dir columns path, version 1 had no directory mtimes, version 2 is the
+# base schema new databases start from.
+V0_SCHEMA = '''
+CREATE TABLE roots (path TEXT NOT NULL PRIMARY KEY);
+CREATE TABLE dirs (path TEXT NOT NULL PRIMARY KEY, parent_id INTEGER);
+'''
+V1_SCHEMA = '''
+CREATE TABLE roots (dir TEXT NOT NULL PRIMARY KEY);
+CREATE TABLE dirs (dir TEXT NOT NULL PRIMARY KEY, parent_id INTEGER);
+'''
+OLD_TABLES = ';\n'.join([CreateTrackTableQuery, CreateSearchTableQuery]) + ';\n'
+
+FIXTURE_ROWS = '''
+INSERT INTO roots VALUES ('/music/');
+INSERT INTO dirs (OID, %(dir)s, parent_id) VALUES (1, '/music/', NULL);
+INSERT INTO dirs (OID, %(dir)s, parent_id) VALUES (2, '/music/abba/', 1);
+'''
+FIXTURE_TRACKS = '''
+INSERT INTO tracks VALUES (2, 'waterloo.mp3', 10, 'Waterloo', 'ABBA', NULL, 'Pop', 'Waterloo', 1, 1974);
+INSERT INTO tracks VALUES (2, 'sos.mp3', 11, 'ABBA', 'ABBA', NULL, NULL, 'SOS', 2, NULL);
+'''
+
+TABLES = ['album_totals', 'albums', 'artists', 'dirs', 'genres', 'library_totals', 'roots', 'searches', 'tracks']
+
+class MigrationTest(unittest.TestCase):
+  def setUp(self):
+    self.conn = sqlite3.connect(':memory:')
+    self.conn.isolation_level = None
+    self.conn.text_factory = str
+
+  def tearDown(self):
+    self.conn.close()
+
+  def fixture(self, script):
+    self.conn.executescript(script)
+
+  def get_schema(self):
+    return self.conn.execute('SELECT type, name, sql FROM sqlite_master ORDER BY type, name').fetchall()
+
+  def get_names(self, type):
+    return [row[0] for row in self.conn.execute('SELECT name FROM sqlite_master WHERE type = ? ORDER BY name', (type, ))]
+
+  def get_tracks(self):
+    return self.conn.execute('SELECT path, album, artist, genre, title, track, year FROM track_info ORDER BY path').fetchall()
+
+  def check_schema(self):
+    self.assertEqual(get_schema_version(self.conn), SCHEMA_VERSION)
+    for table in TABLES:
+      self.assert_(table in self.get_names('table'), table)
+    self.assertEqual(self.get_names('view'), ['track_info'])
+    self.assertEqual(get_column_names(self.conn, 'roots'), ['dir'])
+    self.assertEqual(get_column_names(self.conn, 'dirs'), ['dir', 'mtime', 'parent_id'])
+    self.assert_('album_id' in get_column_names(self.conn, 'tracks'))
+
+  # Running migrate again on a migrated database changes nothing.
+  def check_rerun(self):
+    schema = self.get_schema()
+    tracks = self.get_tracks()
+    self.assertEqual(migrate(self.conn), SCHEMA_VERSION)
+    self.assertEqual(self.get_schema(), schema)
+    self.assertEqual(self.get_tracks(), tracks)
+
+  def check_fixture_tracks(self):
+    self.assertEqual(self.get_tracks(), [
+      ('/music/abba/sos.mp3', 'ABBA', 'ABBA', '', 'SOS', 2, None),
+      ('/music/abba/waterloo.mp3', 'Waterloo', 'ABBA', 'Pop', 'Waterloo', 1, 1974),
+    ])
+    totals = dict(self.conn.execute(GetLibraryTotalsQuery).fetchall())
+    self.assertEqual(totals, { 'dirs': 2, 'tracks': 2 })
+
+  def test_empty(self):
+    self.assertEqual(migrate(self.conn), 0)
+    self.check_schema()
+    self.assertEqual(self.get_tracks(), [])
+    self.check_rerun()
+
+  def test_v0(self):
+    self.fixture(V0_SCHEMA + OLD_TABLES + FIXTURE_ROWS % { 'dir': 'path' } + FIXTURE_TRACKS)
+    self.assertEqual(migrate(self.conn), 0)
+    self.check_schema()
+    self.check_fixture_tracks()
+    self.check_rerun()
+
+  def test_v1(self):
+    self.fixture(V1_SCHEMA + OLD_TABLES + FIXTURE_ROWS % { 'dir': 'dir' } + FIXTURE_TRACKS)
+    migrate(self.conn)
+    self.check_schema()
+    self.check_fixture_tracks()
+    self.check_rerun()
+
+  def test_v2(self):
+    self.fixture(CreateBaseSchemaScript + FIXTURE_ROWS % { 'dir': 'dir' } + FIXTURE_TRACKS)
+    migrate(self.conn)
+    self.check_schema()
+    self.check_fixture_tracks()
+    self.check_rerun()
+
+  # The versions before user_version created missing tables on every
+  # start, a legacy database without tracks or searches is repaired.
+  def test_v0_missing_tables(self):
+    self.fixture(V0_SCHEMA + FIXTURE_ROWS % { 'dir': 'path' })
+    migrate(self.conn)
+    self.check_schema()
+    self.assertEqual(self.get_tracks(), [])
+    self.check_rerun()
+
+  def test_newer_version(self):
+    self.conn.execute(SetUserVersionQuery % (SCHEMA_VERSION + 1))
+    self.assertEqual(migrate(self.conn), SCHEMA_VERSION + 1)
+    self.assertEqual(self.get_names('table'), [])
+
+if __name__ == '__main__':
+  unittest.main()
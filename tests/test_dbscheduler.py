@@ -0,0 +1,122 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pymethlab'))
+
+from dbscheduler import *
+
+class QueueTest(unittest.TestCase):
+  def drain(self, queue):
+    items = []
+    while queue.qsize():
+      items.append(queue.get())
+      queue.task_done()
+    return items
+
+  # Runs function on a thread, returns the thread once it is blocked or
+  # done.
+  def start(self, function):
+    thread = threading.Thread(target = function)
+    thread.setDaemon(True)
+    thread.start()
+    thread.join(0.2)
+    return thread
+
+  def test_priority(self):
+    queue = DBPriorityQueue(fairness = 0)
+    for item in ('b1', 'b2'):
+      queue.put(item, PRIORITY_BULK)
+    for item in ('i1', 'i2'):
+      queue.put(item, PRIORITY_INTERACTIVE)
+    self.assertEqual((queue.qsize(PRIORITY_INTERACTIVE), queue.qsize(PRIORITY_BULK)), (2, 2))
+    self.assertEqual(self.drain(queue), ['i1', 'i2', 'b1', 'b2'])
+
+  # After fairness interactive messages in a row, a bulk one is served.
+  def test_fairness(self):
+    queue = DBPriorityQueue(fairness = 2)
+    for item in ('b1', 'b2', 'b3'):
+      queue.put(item, PRIORITY_BULK)
+    for item in ('i1', 'i2', 'i3', 'i4', 'i5'):
+      queue.put(item, PRIORITY_INTERACTIVE)
+    self.assertEqual(self.drain(queue), ['i1', 'i2', 'b1', 'i3', 'i4', 'b2', 'i5', 'b3'])
+
+  def test_thread_priority(self):
+    queue = DBPriorityQueue()
+    def put():
+      set_thread_priority(PRIORITY_BULK)
+      queue.put('b')
+    self.start(put)
+    queue.put('i')
+    self.assertEqual(get_thread_priority(), PRIORITY_INTERACTIVE)
+    self.assertEqual((queue.qsize(PRIORITY_INTERACTIVE), queue.qsize(PRIORITY_BULK)), (1, 1))
+
+  # A producer blocks while its own queue is full, not the other one.
+  def test_full(self):
+    queue = DBPriorityQueue(1, 1)
+    queue.put('b1', PRIORITY_BULK)
+    thread = self.start(lambda: queue.put('b2', PRIORITY_BULK))
+    self.assert_(thread.isAlive())
+    queue.put('i1', PRIORITY_INTERACTIVE)
+    self.assertEqual(queue.qsize(), 2)
+    self.assertEqual(queue.get(), 'i1')
+    self.assert_(thread.isAlive())
+    self.assertEqual(queue.get(), 'b1')
+    thread.join(1)
+    self.assert_(not thread.isAlive())
+    self.assertEqual(queue.get(), 'b2')
+
+  # A consumer queueing a message (from a callback) never blocks.
+  def test_consumer_does_not_block(self):
+    queue = DBPriorityQueue(1)
+    queue.add_consumer()
+    queue.put('i1')
+    queue.put('i2')
+    self.assertEqual(queue.qsize(), 2)
+
+  def test_get_blocks_until_put(self):
+    queue = DBPriorityQueue()
+    items = []
+    thread = self.start(lambda: items.append(queue.get()))
+    self.assert_(thread.isAlive())
+    queue.put('i1', PRIORITY_BULK)
+    thread.join(1)
+    self.assertEqual(items, ['i1'])
+
+  def test_join(self):
+    queue = DBPriorityQueue()
+    queue.put('i1')
+    thread = self.start(queue.join)
+    self.assert_(thread.isAlive())
+    queue.get()
+    self.assert_(thread.isAlive())
+    queue.task_done()
+    thread.join(1)
+    self.assert_(not thread.isAlive())
+
+  def test_idle_time(self):
+    queue = DBPriorityQueue()
+    queue.put('i1')
+    self.assert_(queue.idle_time() < 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,273 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pymethlab'))
+
+from querytranslator import *
+from querytranslator import QueryTranslator
+from db import DBThread
+
+# A table with the columns the queries below use, holding every combination
+# of a few values and NULL, to compare the results of two translations.
+def create_fixture(values):
+  conn = sqlite3.connect(':memory:')
+  conn.text_factory = str
+  conn.execute('CREATE TABLE track_info (%s)' % ', '.join(['%s %s' % (column, kind) for column, kind, column_values in values]))
+  rows = [()]
+  for column, kind, column_values in values:
+    rows = [row + (value, ) for row in rows for value in column_values]
+  conn.executemany('INSERT INTO track_info VALUES (%s)' % ', '.join(['?'] * len(values)), rows)
+  return conn
+
+def select(conn, sql, symbols):
+  return sorted(conn.execute('SELECT * FROM track_info WHERE ' + sql, symbols).fetchall())
+
+class TranslateTest(unittest.TestCase):
+  def check(self, query, sql, symbols):
+    self.assertEqual(translate_query(query), (sql, symbols))
+
+  def test_comparisons(self):
+    self.check('artist = abba', 'artist = ? COLLATE NOCASE', ('abba', ))
+    self.check('artist != "ABBA"', 'artist <> ? COLLATE NOCASE', ('ABBA', ))
+    self.check('title = "a_c"', 'title LIKE ?', ('a_c', ))
+    self.check('year = 1', 'year LIKE ?', ('1', ))
+    self.check('year != 1', 'year NOT LIKE ?', ('1', ))
+    self.check('year <= 2000 AND year >= 1990', 'year <= ? AND year >= ?', ('2000', '1990'))
+    self.check('track < "3" OR track > 5', 'track < ? OR track > ?', ('3', '5'))
+
+  def test_strings(self):
+    self.check('artist = "The Who"', 'artist = ? COLLATE NOCASE', ('The Who', ))
+    self.check("artist = 'The Who'", 'artist = ? COLLATE NOCASE', ('The Who', ))
+    self.check(r'artist = "it\"s"', 'artist = ? COLLATE NOCASE', ('it"s', ))
+    self.check(r"title = 'a\\b'", 'title = ? COLLATE NOCASE', ('a\\b', ))
+    self.check('title = "a=b (c)"', 'title = ? COLLATE NOCASE', ('a=b (c)', ))
+    self.check('artist=abba', 'artist = ? COLLATE NOCASE', ('abba', ))
+
+  def test_precedence(self):
+    self.check('year = 1 OR year = 2 AND track = 3', 'year LIKE ? OR (year LIKE ? AND track LIKE ?)', ('1', '2', '3'))
+    self.check('(year = 1 OR year = 2) AND track = 3', '(year LIKE ? OR year LIKE ?) AND track LIKE ?', ('1', '2', '3'))
+    self.check('NOT year = 1 AND track = 2', 'NOT year LIKE ? AND track LIKE ?', ('1', '2'))
+    self.check('NOT (year = 1 AND track = 2)', 'NOT (year LIKE ? AND track LIKE ?)', ('1', '2'))
+    self.check('((year = 1))', 'year LIKE ?', ('1', ))
+
+  def test_optimize(self):
+    # Double negations, nested junctions of the same kind, repeated
+    # operands and absorbed operands.
+    self.check('NOT NOT year = 1', 'year LIKE ?', ('1', ))
+    self.check('NOT NOT NOT year = 1', 'NOT year LIKE ?', ('1', ))
+    self.check('year = 1 OR (year = 2 OR track = 3)', 'year LIKE ? OR year LIKE ? OR track LIKE ?', ('1', '2', '3'))
+    self.check('year > 1 AND year > 1', 'year > ?', ('1', ))
+    self.check('year = 1 OR (year = 1 AND track = 2)', 'year LIKE ?', ('1', ))
+    self.check('year = 1 AND (year = 1 OR track = 2)', 'year LIKE ?', ('1', ))
+    self.check('artist = "x" OR (artist = "x" AND album = "y")', 'artist = ? COLLATE NOCASE', ('x', ))
+    # Exact matches on one field in an OR become an IN, wildcards do not.
+    self.check('artist = "x" OR artist = "y" OR artist = "X"', 'artist COLLATE NOCASE IN (?, ?, ?)', ('x', 'y', 'X'))
+    self.check('artist = "x" OR artist = "y" OR artist = "x"', 'artist COLLATE NOCASE IN (?, ?)', ('x', 'y'))
+    self.check('artist = "x" OR ARTIST = "y"', 'artist COLLATE NOCASE IN (?, ?)', ('x', 'y'))
+    self.check('artist = "x" OR artist = "y_"', 'artist = ? COLLATE NOCASE OR artist LIKE ?', ('x', 'y_'))
+    self.check('artist = "x" AND artist = "y"', 'artist = ? COLLATE NOCASE AND artist = ? COLLATE NOCASE', ('x', 'y'))
+
+  # Optimizing a query does not change its results, also where fields are
+  # NULL and the query is negated.
+  def test_optimize_nulls(self):
+    conn = create_fixture([
+      ('artist', 'TEXT', [None, 'x', 'y']),
+      ('album', 'TEXT', [None, 'a']),
+      ('year', 'INTEGER', [None, 1, 2]),
+      ('track', 'INTEGER', [None, 2]),
+    ])
+    for query in [
+      'NOT NOT year = 1',
+      'NOT (year = 1 OR (year = 1 AND track = 2))',
+      'NOT (year = 1 AND (year = 1 OR track = 2))',
+      'NOT (artist = "x" OR artist = "y")',
+      'NOT (artist = "x" OR artist = "x")',
+      'NOT ((year = 1 OR track = 2) AND (year = 1 OR track = 2))',
+      'NOT ((year = 1 OR track = 2) OR album = "a")',
+      'NOT (artist = "x" OR (artist = "y" AND NOT year = 2) OR NOT artist = "y")',
+      'NOT (artist = "x" OR (album = "a" AND artist = "x" AND track = 2))',
+    ]:
+      translator = QueryTranslator()
+      translator.tokens = translator.tokenize(query)
+      translator.pos = 0
+      symbols = []
+      sql = translator.compile(translator.parse_or(), symbols)
+      self.assertEqual(select(conn, *translate_query(query)), select(conn, sql, symbols), query)
+
+  def test_cache(self):
+    query = 'artist = "cached" OR year = 1'
+    self.assert_(parse_query(query) is parse_query(query))
+    self.assert_(parse_query(query) is not parse_query(query + ' '))
+    cache = QueryCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+  def test_errors(self):
+    for query in [
+      'artist', 'artist =', 'artist abba', '= abba', 'artist = abba OR',
+      'artist = abba AND AND year = 1', 'OR artist = abba', 'NOT',
+      '(artist = abba', 'artist = abba)', '()', 'artist = "abba',
+      "artist = 'abba", 'art-ist = x', 'artist = OR', 'UNDER = x',
+      'artist = abba year = 1', '(' * 2000 + 'year = 1' + ')' * 2000,
+    ]:
+      self.assertRaises(QueryTranslatorException, translate_query, query)
+
+# Patterns that only end in % are compiled to a NOCASE range, without
+# wildcards to a NOCASE comparison. Both select what LIKE does (on UTF-8
+# text, which is how the tags are stored).
+class LikeTest(unittest.TestCase):
+  TITLES = [
+    None, '', 'abba', 'ABBA', 'Ab', 'ab', 'abc', 'b', 'B', 'z', 'Z', 'Zz',
+    '@home', '@Home', 'Ahome', 'ahome', '[x', '`x', '_x', '%x', 'a_c', 'a%c',
+    '100%', '1000', 'a\xc3\xa4', 'A\xc3\x84', 'a\xc3\xbf', '\xc3\xbf\xc3\xbf', '{', '~',
+  ]
+  PATTERNS = [
+    'a%', 'A%', 'Ab%', 'ab%', 'aB%%', '@%', '@h%', '@H%', '`%', '[%', 'Z%',
+    'z%', 'zz%', '%', '%%', '_x%', 'a_%', '%x', 'a%c', '100%', 'a\xc3\xa4%',
+    'A\xc3\xa4%', '\xc3\xbf%', 'abba', 'ABBA', '@HOME', '', '{%', '~%',
+  ]
+
+  def test_prefix_ranges(self):
+    self.assertEqual(translate_query('title = "Ab%"'), ('(title >= ? COLLATE NOCASE AND title < ? COLLATE NOCASE)', ('ab', 'ac')))
+    self.assertEqual(translate_query('title = "%"'), ('title >= ? COLLATE NOCASE', ('', )))
+    # The upper bound of @ would be A, equal to a for NOCASE.
+    self.assertEqual(translate_query('title = "@%"'), ('title LIKE ?', ('@%', )))
+
+  def test_like(self):
+    conn = create_fixture([('title', 'TEXT', self.TITLES)])
+    for pattern in self.PATTERNS:
+      for operator, like in (('=', 'LIKE'), ('!=', 'NOT LIKE')):
+        query = 'title %s "%s"' % (operator, pattern)
+        self.assertEqual(select(conn, *translate_query(query)), select(conn, 'title %s ?' % like, (pattern, )), query)
+
+  def test_get_prefix_range(self):
+    self.assertEqual(get_prefix_range('/music/'), ('/music/', '/music0'))
+    self.assertEqual(get_prefix_range('a\xff\xff'), ('a\xff\xff', 'b'))
+    self.assertEqual(get_prefix_range('\xff'), ('\xff', None))
+    self.assertEqual(get_prefix_range(u'a' + unichr(sys.maxunicode)), (u'a' + unichr(sys.maxunicode), u'b'))
+    self.assertEqual(translate_query("dir UNDER '\xff'"), ('dir >= ?', ('\xff', )))
+
+class GrammarTest(unittest.TestCase):
+  def check(self, query, sql, symbols, order = (), limit = None):
+    translator = parse_query(query)
+    self.assertEqual((translator.sql_query, translator.sql_symbols, translator.order, translator.limit), (sql, symbols, order, limit))
+
+  def test_in(self):
+    self.check('artist IN ("a", b)', 'artist COLLATE NOCASE IN (?, ?)', ('a', 'b'))
+    self.check('artist IN (a) OR artist = b', 'artist COLLATE NOCASE IN (?, ?)', ('a', 'b'))
+    self.check('year IN (1, 2)', 'year IN (?, ?)', ('1', '2'))
+
+  def test_between(self):
+    self.check('year BETWEEN 1990 AND 2000', 'year BETWEEN ? AND ?', ('1990', '2000'))
+    self.check('NOT year BETWEEN 1 AND 2 OR track IN (1)', 'NOT year BETWEEN ? AND ? OR track IN (?)', ('1', '2', '1'))
+
+  def test_order_limit(self):
+    self.check('year > 1 ORDER BY year DESC, Title ASC LIMIT 5', 'year > ?', ('1', ), ('year DESC', 'title ASC'), 5)
+    self.check('ORDER BY year DESC', '1', (), ('year DESC', ))
+    self.check('LIMIT 50', '1', (), (), 50)
+    self.check('ORDER BY id LIMIT 0', '1', (), ('id', ), 0)
+    self.check('', '1', ())
+
+  def test_errors(self):
+    for query in [
+      'artist IN ()', 'artist IN (a', 'artist IN a', 'year BETWEEN 1',
+      'year BETWEEN 1 OR 2', 'ORDER year', 'ORDER BY', 'ORDER BY year,',
+      'ORDER BY foo', 'ORDER BY year DESC DESC',
+      'LIMIT', 'LIMIT -1', 'LIMIT 1.5', 'LIMIT x', 'LIMIT 5 6',
+      'LIMIT 5 ORDER BY year', 'year = 1 LIMIT 5 OR year = 2',
+    ]:
+      self.assertRaises(QueryTranslatorException, parse_query, query)
+
+  def test_max_variables(self):
+    values = ', '.join([str(i) for i in range(QueryTranslator.MAX_VARIABLES)])
+    self.assertEqual(len(translate_query('year IN (%s)' % values)[1]), QueryTranslator.MAX_VARIABLES)
+    self.assertRaises(QueryTranslatorException, translate_query, 'year IN (%s) OR track = 1' % values)
+
+class Tag:
+  def __init__(self, artist, album, title, track, year):
+    self.artist = artist
+    self.album = album
+    self.title = title
+    self.track = track
+    self.year = year
+    self.genre = None
+    self.comment = None
+
+# The mirror answers the queries it can with the same rows as SQL.
+class MirrorTest(unittest.TestCase):
+  TRACKS = [
+    ('/music/', Tag('ABBA', 'Arrival', 'Dancing Queen', 2, 1976)),
+    ('/music/', Tag('abba', 'Gold', 'SOS', None, 1992)),
+    ('/music/beatles/', Tag('The Beatles', 'Abbey Road', 'Come Together', 1, 1969)),
+    ('/music/beatles/', Tag('The Beatles', 'Abbey Road', 'Something', 2, 1969)),
+    ('/music/beatles/', Tag('The Beatles', 'Let It Be', 'Get Back', 12, None)),
+    ('/music/b/', Tag('Blondie', None, 'Atomic', 3, 1979)),
+    ('/music/b/', Tag(None, None, 'Untitled', None, None)),
+    ('/music/\xc3\xbf/', Tag('\xc3\xbf', 'x', 'Last', 1, 2000)),
+  ]
+  QUERIES = [
+    'artist IN ("abba", "blondie")', 'year IN (1969, 1992)', 'NOT year IN (1969)',
+    'year BETWEEN 1970 AND 1992', 'NOT year BETWEEN 1970 AND 1992',
+    'track BETWEEN 2 AND 12 OR artist IN ("the beatles")',
+    'ORDER BY year DESC, title', 'ORDER BY track, path DESC', 'LIMIT 3',
+    'year > 1970 ORDER BY artist, title LIMIT 2', 'ORDER BY title LIMIT 0', '',
+    'dir UNDER "/music/b"', 'dir UNDER "/music/\xc3\xbf"', 'path UNDER "/music/\xc3"',
+  ]
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    path = os.path.join(self.dir, 'methlab.db')
+    self.mirror = DBThread(path, mirror = True, maintenance_budget = None)
+    self.mirror.start()
+    dir_ids = {}
+    tracks = []
+    for i, (dir, tag) in enumerate(self.TRACKS):
+      if not dir in dir_ids:
+        dir_ids[dir] = self.mirror.get_dir_id(dir_ids.get('/music/'), dir)
+      tracks.append((dir_ids[dir], '%i.mp3' % i, 1, tag))
+    session = self.mirror.scan_session()
+    session.add_tracks(tracks)
+    session.close()
+    self.sql = DBThread(path, readers = 0, maintenance_budget = None)
+    self.sql.start()
+
+  def tearDown(self):
+    for db in (self.mirror, self.sql):
+      db.stop()
+      db.join()
+    shutil.rmtree(self.dir)
+
+  def test_same_results(self):
+    for query in self.QUERIES:
+      translator = parse_query(query)
+      self.assert_(self.mirror.mirror.query(translator.terms, translator.order) is not None, query)
+      expected = [tuple(row) for row in self.sql.query_tracks(query)]
+      self.assertEqual([tuple(row) for row in self.mirror.query_tracks(query)], expected, query)
+      self.assertEqual(self.mirror.count_tracks(query), self.sql.count_tracks(query), query)
+
+if __name__ == '__main__':
+  unittest.main()
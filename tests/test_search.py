@@ -0,0 +1,117 @@
+#  methlab - A music library application
+#  Copyright (C) 2007 Ingmar K. Steen (iksteen@gmail.com)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pymethlab'))
+
+from db import *
+from searchtranslator import parse_search
+
+class Tag:
+  def __init__(self, artist, album, title, genre = None):
+    self.artist = artist
+    self.album = album
+    self.title = title
+    self.genre = genre
+    self.comment = None
+    self.track = None
+    self.year = None
+
+TRACKS = [
+  Tag('The Beatles', 'Abbey Road', 'Come Together', 'Rock'),
+  Tag('The Beatles', 'Let It Be', 'Get Back', 'Rock'),
+  Tag('The Velvet Underground', 'Loaded', 'Sweet Jane', 'Rock'),
+  Tag('AC/DC', 'Back in Black', 'Hells Bells', 'Hard Rock'),
+  Tag('The Clash', 'London Calling', 'T-Clash Blues'),
+  Tag('Lilith', 'Beat Street', 'Lullaby', 'Pop'),
+  Tag('ABBA', 'Arrival', 'Dancing Queen', 'Pop'),
+  Tag(None, None, 'Untitled beat'),
+  Tag('Beat_Happening', '100% Fun', None),
+]
+
+# Plain-text searches are substring matches, whichever engine answers them.
+SEARCHES = [
+  'beat', 'tles', 'ground', 'li', '-li', 'beat -li', 'c/d', 't-cl', 'CLASH',
+  'come together', '"come together"', 'artist:beat', '-artist:beat',
+  'genre:rock -title:back', 'abba | lilith', 'beat_', '100%', 'nothing',
+]
+
+class SearchTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    path = os.path.join(self.dir, 'methlab.db')
+    self.mirror = DBThread(path, mirror = True, maintenance_budget = None)
+    self.mirror.start()
+    root = self.mirror.get_dir_id(None, '/music/')
+    session = self.mirror.scan_session()
+    session.add_tracks([(root, '%i.mp3' % i, 1, tag) for i, tag in enumerate(TRACKS)])
+    session.close()
+    self.fts = DBThread(path, readers = 0, maintenance_budget = None)
+    self.fts.start()
+    self.like = DBThread(path, readers = 0, maintenance_budget = None)
+    self.like.start()
+    self.like.fts = None
+
+  def tearDown(self):
+    for db in (self.mirror, self.fts, self.like):
+      db.stop()
+      db.join()
+    shutil.rmtree(self.dir)
+
+  def search(self, db, query):
+    db.last_search = None
+    db.cache.clear()
+    return [tuple(row) for row in db.search_tracks(query)]
+
+  def test_engines(self):
+    self.assert_(self.mirror.mirror.can_search(self.mirror.get_search_fields()))
+    self.assertEqual(self.fts.fts, 'fts5')
+    self.assert_('tracks_fts' in self.fts.get_search_queries(parse_search('tles'))[0])
+    self.assertEqual(self.like.mirror, None)
+
+  def test_same_results(self):
+    for fields in (('artist', 'album', 'title'), ('title', 'genre')):
+      for db in (self.mirror, self.fts, self.like):
+        db.set_search_fields(*fields)
+      for query in SEARCHES:
+        expected = self.search(self.like, query)
+        self.assertEqual(self.search(self.mirror, query), expected, query)
+        self.assertEqual(self.search(self.fts, query), expected, query)
+
+  def test_substrings(self):
+    titles = lambda query: sorted([row['title'] for row in self.fts.search_tracks(query)])
+    self.assertEqual(titles('tles'), ['Come Together', 'Get Back'])
+    self.assertEqual(titles('ground'), ['Sweet Jane'])
+    self.assertEqual(titles('c/d'), ['Hells Bells'])
+
+  # A search refining the last one is filtered from its results, which
+  # gives the same results as searching anew.
+  def test_refinement(self):
+    queries = ['b', 'be', 'bea', 'beat', 'beat -l', 'beat -li']
+    expected = [self.search(self.like, query) for query in queries]
+    for db in (self.mirror, self.fts, self.like):
+      db.last_search = None
+      for query, rows in zip(queries, expected):
+        self.assertEqual([tuple(row) for row in db.search_tracks(query)], rows, query)
+
+if __name__ == '__main__':
+  unittest.main()